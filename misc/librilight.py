@@ -1,95 +1,231 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from tqdm import tqdm
 from urllib.parse import urlparse
+import argparse
 import json
 import os
 import re
 import requests
+import shutil
 import sys
+import threading
+import time
 import traceback
 
 book_id_re = re.compile(r'/(\d+)(/|$)')
+natural_re = re.compile(r'(\d+)')
 
 name_nonces = defaultdict(int)
 
-def get_book(dst, gut_id):
-    book_path = os.path.join(dst, str(gut_id) + '.txt')
-    if os.path.exists(book_path):
-        return book_path
-    file_url = 'http://www.gutenberg.org/files/{}/'.format(gut_id)
-    resp = requests.get(file_url)
-    submatch = re.search(r'\b{}[\w-]*\.txt\b'.format(gut_id), resp.text)
-    if submatch:
-        submatch = submatch.group(0)
-        resp = requests.get(file_url + submatch)
-        with open(book_path, 'w') as f:
+class RateLimit:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class BookCache:
+    """Fetches Gutenberg books into cache_dir, remembering each lookup in cache_dir/index.tsv.
+
+    The index maps a book id to its cached .txt name, or '-' if no text file was found,
+    so neither successes nor misses are fetched again.
+    """
+    def __init__(self, cache_dir, mirror='http://www.gutenberg.org', rate=2.0, jobs=8):
+        self.cache_dir = cache_dir
+        self.mirror = mirror.rstrip('/')
+        self.limit = RateLimit(rate)
+        self.jobs = jobs
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(cache_dir, 'index.tsv')
+        self.index = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    if line.endswith('\n') and '\t' in line:
+                        gut_id, name = line.rstrip('\n').split('\t', 1)
+                        self.index[gut_id] = name
+
+    def get(self, url):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        self.limit.wait()
+        resp = session.get(url)
+        resp.raise_for_status()
+        return resp
+
+    def record(self, gut_id, name):
+        with self.lock:
+            self.index[gut_id] = name
+            with open(self.index_path, 'a') as o:
+                o.write('{}\t{}\n'.format(gut_id, name))
+
+    def path(self, gut_id):
+        name = self.index.get(gut_id)
+        if name and name != '-':
+            return os.path.join(self.cache_dir, name)
+        return None
+
+    def fetch(self, gut_id):
+        if gut_id in self.index:
+            return self.path(gut_id)
+        book_path = os.path.join(self.cache_dir, str(gut_id) + '.txt')
+        if os.path.exists(book_path):
+            # books fetched before the index existed
+            self.record(gut_id, os.path.basename(book_path))
+            return book_path
+        file_url = '{}/files/{}/'.format(self.mirror, gut_id)
+        resp = self.get(file_url)
+        submatch = re.search(r'\b{}[\w-]*\.txt\b'.format(gut_id), resp.text)
+        if not submatch:
+            self.record(gut_id, '-')
+            return None
+        resp = self.get(file_url + submatch.group(0))
+        tmp = book_path + '.tmp'
+        with open(tmp, 'w') as f:
             f.write(resp.text)
+        os.rename(tmp, book_path)
+        self.record(gut_id, os.path.basename(book_path))
         return book_path
-    raise Exception('could not find book url')
 
-def main(src, audio_src, dst):
+    def fetch_all(self, gut_ids):
+        todo = sorted(set(gut_ids) - set(self.index))
+        def fetch_one(gut_id):
+            try:
+                return self.fetch(gut_id)
+            except Exception:
+                print('Error fetching book', gut_id)
+                traceback.print_exc()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            for _ in tqdm(pool.map(fetch_one, todo), desc='Fetching Books', total=len(todo)):
+                pass
+        return {gut_id: self.path(gut_id) for gut_id in gut_ids}
+
+def load_meta(args):
+    json_path, audio_src = args
+    try:
+        with open(json_path, 'r', encoding='utf8') as f:
+            j = json.load(f)
+        pathname = os.path.basename(json_path).rsplit('.', 1)[0]
+        json_dir = os.path.dirname(json_path)
+
+        if pathname.endswith('_speaker_data'):
+            return None
+
+        audio_files = []
+        if pathname.endswith('_metadata'):
+            pathname = pathname.rsplit('_', 1)[0]
+            # partial mp3 path
+            book_meta = j
+            speaker_data_path = os.path.join(json_dir, pathname) + '_speaker_data.json'
+            with open(speaker_data_path, 'r') as f:
+                speaker_data = json.load(f)
+
+            speakers = dict(zip([name.rsplit('_', 1)[0] for name in speaker_data['names']],
+                                [reader[0] for reader in speaker_data['readers'] if reader]))
+            mp3_dir = os.path.join(audio_src, pathname)
+            for entry in os.scandir(mp3_dir):
+                if entry.path.endswith(('.mp3', '.flac')):
+                    reader = speakers.get(entry.name.rsplit('_', 1)[0], '0')
+                    audio_files.append((reader, entry.path))
+        else:
+            # flac prepared path
+            audio_path = os.path.join(json_dir, pathname + '.flac')
+            if not os.path.exists(audio_path):
+                return None
+            book_meta = j['book_meta']
+            audio_files = [(j['speaker'], audio_path)]
+
+        txt_path = os.path.join(json_dir, pathname) + '_text.txt'
+        gut_id = None
+        if not os.path.exists(txt_path):
+            txt_path = None
+            url_text = book_meta['url_text_source']
+            url = urlparse(url_text)
+            if url_text and url.hostname and url.hostname.endswith('gutenberg.org'):
+                match = book_id_re.search(url.path)
+                if match:
+                    gut_id = match.group(1)
+        return json_path, book_meta['id'], sorted(audio_files), txt_path, gut_id
+    except Exception:
+        print('Error at', json_path)
+        traceback.print_exc()
+        return None
+
+def natural_key(path):
+    name = os.path.basename(path)
+    return [int(part) if part.isdigit() else part for part in natural_re.split(name)]
+
+def write_chapters(dst, chapters):
+    """Write dst/chapters.tsv: each recording's name and its chapter number within the book.
+
+    Output names start with the speaker id, so only the source file names carry the reading order.
+    """
+    path = os.path.join(dst, 'chapters.tsv')
+    with open(path + '.tmp', 'w') as o:
+        for lv_id in sorted(chapters):
+            for index, (_, name) in enumerate(sorted(chapters[lv_id], key=lambda c: natural_key(c[0]))):
+                o.write('{}\t{}\n'.format(name, index))
+    os.replace(path + '.tmp', path)
+
+def local_book(book_path, dst, copies):
+    """A path to the book on dst's filesystem, copying it into dst/.books once if the cache is elsewhere.
+
+    Recordings of a book are hardlinks to one file, which is how wav2train --window finds chapters.
+    """
+    if book_path in copies:
+        return copies[book_path]
+    local = book_path
+    if os.stat(book_path).st_dev != os.stat(dst).st_dev:
+        books_dir = os.path.join(dst, '.books')
+        os.makedirs(books_dir, exist_ok=True)
+        local = os.path.join(books_dir, os.path.basename(book_path))
+        if not os.path.exists(local):
+            shutil.copyfile(book_path, local + '.tmp')
+            os.replace(local + '.tmp', local)
+    copies[book_path] = local
+    return local
+
+def main(src, audio_src, dst, cache_dir=None, mirror='http://www.gutenberg.org', rate=2.0, fetch_jobs=8, jobs=None):
     os.makedirs(dst, exist_ok=True)
+    books = BookCache(cache_dir or dst, mirror=mirror, rate=rate, jobs=fetch_jobs)
 
     queue = []
     for root, dirs, names in os.walk(src):
         for name in names:
             if name.endswith('.json'):
-                queue.append(os.path.join(root, name))
+                queue.append((os.path.join(root, name), audio_src))
 
-    for json_path in tqdm(queue, desc='Finding Books'):
-        try:
-            with open(json_path, 'r', encoding='utf8') as f:
-                j = json.load(f)
-            pathname = os.path.basename(json_path).rsplit('.', 1)[0]
-            json_dir = os.path.dirname(json_path)
-
-            if pathname.endswith('_speaker_data'):
-                continue
-
-            audio_files = []
-            if pathname.endswith('_metadata'):
-                pathname = pathname.rsplit('_', 1)[0]
-                # partial mp3 path
-                book_meta = j
-                speaker_data_path = os.path.join(json_dir, pathname) + '_speaker_data.json'
-                with open(speaker_data_path, 'r') as f:
-                    speaker_data = json.load(f)
-
-                speakers = dict(zip([name.rsplit('_', 1)[0] for name in speaker_data['names']],
-                                    [reader[0] for reader in speaker_data['readers'] if reader]))
-                mp3_dir = os.path.join(audio_src, pathname)
-                for entry in os.scandir(mp3_dir):
-                    if entry.path.endswith(('.mp3', '.flac')):
-                        reader = speakers.get(entry.name.rsplit('_', 1)[0], '0')
-                        audio_files.append((reader, entry.path))
-            else:
-                # flac prepared path
-                audio_path = os.path.join(json_dir, pathname + '.flac')
-                if not os.path.exists(audio_path):
-                    continue
-                book_meta = j['book_meta']
-                audio_files = [(j['speaker'], audio_path)]
-
-            txt_path = os.path.join(json_dir, pathname) + '_text.txt'
-            book_path = ''
-            if os.path.exists(txt_path):
-                book_path = txt_path
-            else:
-                url_text = book_meta['url_text_source']
-                url = urlparse(url_text)
-                if url_text and url.hostname and url.hostname.endswith('gutenberg.org'):
-                    match = book_id_re.search(url.path)
-                    if match:
-                        gut_id = match.group(1)
-                        book_path = get_book(dst, gut_id)
+    with Pool(jobs) as pool:
+        metas = [meta for meta in tqdm(pool.imap(load_meta, queue, chunksize=16), desc='Finding Books', total=len(queue))
+                 if meta is not None]
 
+    book_paths = books.fetch_all([gut_id for _, _, _, _, gut_id in metas if gut_id])
+    copies = {}
+    chapters = defaultdict(list)
+
+    for json_path, lv_id, audio_files, txt_path, gut_id in metas:
+        try:
+            book_path = txt_path or book_paths.get(gut_id)
             if book_path:
-                for spk_id, audio_file in sorted(audio_files):
-                    lv_id = book_meta['id']
+                book_path = local_book(book_path, dst, copies)
+                for spk_id, audio_file in audio_files:
                     id_str = '{}_{}'.format(spk_id, lv_id)
                     nonce = name_nonces[id_str]
                     name_nonces[id_str] += 1
                     name = '{}-{}'.format(id_str, nonce)
+                    chapters[lv_id].append((audio_file, name))
 
                     dst_name = os.path.join(dst, name)
                     try: os.link(book_path, dst_name + '.txt')
@@ -99,12 +235,24 @@ def main(src, audio_src, dst):
         except Exception:
             print('Error at', json_path)
             traceback.print_exc()
+    write_chapters(dst, chapters)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Usage: librilight-prep <input> [<audio_dir>] <output>')
+    parser = argparse.ArgumentParser(usage='librilight-prep <input> [<audio_dir>] <output>')
+    parser.add_argument('paths',   help='<input> [<audio_dir>] <output>', nargs='+')
+    parser.add_argument('--cache', help='book cache directory (default: output)', type=str, default=None)
+    parser.add_argument('--mirror', help='Gutenberg base url, e.g. a local mirror', type=str, default='http://www.gutenberg.org')
+    parser.add_argument('--rate',  help='max book requests per second (0 = unlimited)', type=float, default=2.0)
+    parser.add_argument('--fetch-jobs', help='concurrent book downloads', type=int, default=8)
+    parser.add_argument('--jobs', '-j', help='parallel metadata parsers (default: cpu count)', type=int, default=None)
+    args = parser.parse_args()
+    if len(args.paths) not in (2, 3):
+        parser.print_usage()
         sys.exit(1)
-    if len(sys.argv) == 4:
-        main(sys.argv[1], sys.argv[2], sys.argv[3])
+    if len(args.paths) == 3:
+        src, audio_src, dst = args.paths
     else:
-        main(sys.argv[1], sys.argv[1], sys.argv[2])
+        src, dst = args.paths
+        audio_src = src
+    main(src, audio_src, dst, cache_dir=args.cache, mirror=args.mirror, rate=args.rate,
+         fetch_jobs=args.fetch_jobs, jobs=args.jobs)
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Vectorized helpers over 16-bit mono PCM, as numpy int16 arrays.
+
+full_scale = 32768.0
+frame_ms = 10
+
+def samples(segment):
+    """int16 samples of a mono 16-bit pydub AudioSegment."""
+    return np.frombuffer(segment.raw_data, dtype=np.int16)
+
+def frame_db(x, rate, frame_ms=frame_ms):
+    """RMS level of each frame in dBFS. A trailing partial frame is dropped."""
+    frame = max(1, rate * frame_ms // 1000)
+    n = len(x) // frame
+    if not n:
+        return np.zeros(0)
+    frames = x[:n * frame].astype(np.float64).reshape(n, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(rms / full_scale + 1e-10)
+
+def trim_bounds(x, rate, threshold_db=-40.0, pad_ms=100):
+    """(start, end) sample range without leading and trailing frames quieter than threshold_db.
+
+    pad_ms of audio is kept on each side of the loud region. If no frame is loud enough
+    the whole range is returned, a quiet clip is left for the other filters to judge.
+    """
+    frame = max(1, rate * frame_ms // 1000)
+    loud = np.flatnonzero(frame_db(x, rate) > threshold_db)
+    if not len(loud):
+        return 0, len(x)
+    pad = rate * pad_ms // 1000
+    start = max(0, loud[0] * frame - pad)
+    end = min(len(x), (loud[-1] + 1) * frame + pad)
+    return int(start), int(end)
+
+def normalize(x, mode='peak', target_db=None):
+    """Scale x so its peak (or RMS) level hits target_db dBFS, clipping to int16."""
+    if not len(x):
+        return x
+    xf = x.astype(np.float64)
+    if mode == 'peak':
+        target_db = -1.0 if target_db is None else target_db
+        level = np.max(np.abs(xf)) / full_scale
+    elif mode == 'rms':
+        target_db = -20.0 if target_db is None else target_db
+        level = np.sqrt(np.mean(xf * xf)) / full_scale
+    else:
+        raise ValueError('unknown normalization: {}'.format(mode))
+    if level <= 0:
+        return x
+    gain = 10 ** (target_db / 20) / level
+    return np.clip(np.round(xf * gain), -32768, 32767).astype(np.int16)
+
+def to_int16(x, bits):
+    """int16 samples from integer samples of another bit depth."""
+    if bits > 16:
+        x = x >> (bits - 16)
+    elif bits < 16:
+        x = x << (16 - bits)
+    return x.astype(np.int16)
+
+def clip_ratio(x):
+    """Fraction of samples at full scale."""
+    if not len(x):
+        return 0.0
+    return np.count_nonzero((x >= 32767) | (x <= -32768)) / len(x)
+
+def rms_db(x):
+    """RMS level of the whole clip in dBFS."""
+    if not len(x):
+        return 20 * np.log10(1e-10)
+    xf = x.astype(np.float64)
+    return 20 * np.log10(np.sqrt(np.mean(xf * xf)) / full_scale + 1e-10)
+
+def silence_ratio(x, rate, threshold_db=-40.0):
+    """Fraction of frames quieter than threshold_db."""
+    db = frame_db(x, rate)
+    if not len(db):
+        return 1.0
+    return np.count_nonzero(db < threshold_db) / len(db)
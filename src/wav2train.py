@@ -1,17 +1,25 @@
 from multiprocessing.pool import Pool
-from pydub import AudioSegment
-from tqdm import tqdm
 import argparse
 import gc
+import hashlib
 import itertools
 import json
 import logging
+import math
 import multiprocessing
 import os
+import queue
 import re
 import subprocess
 import sys
+import time
 import traceback
+import wbucket
+import windex
+import wmerge
+import wstt
+import wsupervise
+import wwindow
 
 basedir = os.path.dirname(os.path.realpath(os.path.dirname(__file__)))
 dsalign_dir = os.path.join(basedir, 'DSAlign')
@@ -26,74 +34,265 @@ def canonicalize(text):
     text = can_re.sub(' ', text)
     return text
 
+def input_name(path):
+    return os.path.basename(path).rsplit('.', 1)[0]
+
 def align(args):
-    size, audio_file, transcript_file, align_dir, jobs, verbose, model = args
+    size, audio_file, transcript_file, align_dir, jobs, verbose, model, sup, batched, chapter = args
     name = os.path.basename(audio_file).rsplit('.', 1)[0]
     tlog = os.path.join(align_dir, name + '.tlog')
     aligned = os.path.join(align_dir, name + '-aligned.json')
     linked_transcript = os.path.join(align_dir, os.path.basename(transcript_file))
+    if chapter is not None:
+        # windowed transcripts differ per recording, so they can't share one linked file
+        linked_transcript = os.path.join(align_dir, name + '.window.txt')
     if os.path.exists(aligned):
-        return audio_file, aligned, linked_transcript
-    with open(linked_transcript, 'w') as o, open(transcript_file, 'r') as f:
-        o.write(canonicalize(f.read()))
-    argv = ['python', align_exe,
-        '--audio-vad-aggressiveness', '2',
-        '--stt-workers',    str(jobs),
-        '--output-max-cer', '25',
-        '--audio',   audio_file,
-        '--script',  linked_transcript,
-        '--aligned', aligned,
-        '--tlog',    tlog,
-        '--force',
-    ]
-    if model is not None:
-        argv += ['--stt-model-dir', model]
-    if verbose:
-        print(' '.join(argv))
-        p = subprocess.Popen(argv, stdin=devnull)
+        return audio_file, aligned, linked_transcript, None, 0.0, 0.0
+    with open(transcript_file, 'r') as f:
+        text = canonicalize(f.read())
+    if chapter is not None:
+        start, end, reason = wwindow.window(text, audio_file, align_dir, chapter, model_dir=model or 'models/en')
+        logging.debug('[+] Window {}: {}-{} of {} chars ({})'.format(name, start, end, len(text), reason))
+        text = text[start:end]
+        with open(wwindow.window_path(align_dir, name), 'w') as o:
+            json.dump({'start': start, 'end': end, 'reason': reason}, o)
+    with open(linked_transcript, 'w') as o:
+        o.write(text)
+    if batched:
+        # transcribed by the shared STT service, align.py only aligns the tlog
+        argv = ['python', align_exe,
+            '--output-max-cer', '25',
+            '--script',  linked_transcript,
+            '--aligned', aligned,
+            '--tlog',    tlog,
+        ]
     else:
+        argv = ['python', align_exe,
+            '--audio-vad-aggressiveness', '2',
+            '--stt-workers',    str(jobs),
+            '--output-max-cer', '25',
+            '--audio',   audio_file,
+            '--script',  linked_transcript,
+            '--aligned', aligned,
+            '--tlog',    tlog,
+            '--force',
+        ]
+        if model is not None:
+            argv += ['--stt-model-dir', model]
+    if not verbose:
         argv += ['--no-progress']
-        p = subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
-    _, err = p.communicate()
-    err = (err or b'').strip().decode('utf8')
-    for line in err.split('\n'):
-        if line.startswith(('TensorFlow: v', 'DeepSpeech: v')):
-            continue
-        if line.startswith('Warning: reading entire model'):
-            continue
-        if 'Your CPU supports instructions' in line:
+    duration = wsupervise.audio_duration(audio_file)
+    timeout = wsupervise.timeout_for(sup, duration)
+    start = time.monotonic()
+    error = None
+    for attempt in range(sup['retries'] + 1):
+        wsupervise.wait_retry(sup, attempt)
+        # own session, so a timeout kills align.py and its stt workers together
+        if verbose:
+            print(' '.join(argv))
+            p = subprocess.Popen(argv, stdin=devnull, start_new_session=True)
+        else:
+            p = subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            _, err = wsupervise.communicate(p, timeout)
+        except subprocess.TimeoutExpired:
+            error = 'timed out after {:.0f}s'.format(timeout)
+            logging.debug('[-] Align {}: {} (attempt {})'.format(name, error, attempt + 1))
             continue
-        logging.debug(line)
+        err = (err or b'').strip().decode('utf8')
+        for line in err.split('\n'):
+            if line.startswith(('TensorFlow: v', 'DeepSpeech: v')):
+                continue
+            if line.startswith('Warning: reading entire model'):
+                continue
+            if 'Your CPU supports instructions' in line:
+                continue
+            logging.debug(line)
+        if p.returncode == 0 and os.path.exists(aligned):
+            error = None
+            break
+        error = 'align.py exited with status {}'.format(p.returncode)
+        logging.debug('[-] Align {}: {} (attempt {})'.format(name, error, attempt + 1))
     try: os.unlink(os.path.join(align_dir, name + '.arpa'))
     except Exception: pass
-    return (audio_file, aligned, linked_transcript)
+    elapsed = time.monotonic() - start
+    fail = None
+    if error is not None:
+        fail = wsupervise.failure('align', audio_file, error, attempt + 1, elapsed, duration)
+    return (audio_file, aligned, linked_transcript, fail, elapsed, duration)
 
-def segment(args):
-    audio_file, aligned_path, txt_path, clips_dir, alphabet = args
-    words_re = re.compile(alphabet)
-    name = os.path.basename(audio_file).split('.')[0]
-    skipped = 0
-    results = []
+def segment_pcm_path(aligned_path):
+    return aligned_path.rsplit('-aligned.json', 1)[0] + '.segment.pcm'
+
+def plan_segments(args):
+    """Count a file's aligned segments. A file that will be split across workers is decoded
+    here once, to raw PCM, so each part can read just its own span.
+
+    Returns (job, count, pcm, fail), the decode is supervised like segment() itself.
+    """
+    from pydub import AudioSegment
+    job, split = args
+    audio_file, aligned_path = job[:2]
+    sup = job[6]
     try:
         with open(aligned_path, 'r') as f:
             aligned_json = json.load(f)
+    except Exception:
+        return job, 0, None, None
+    count = len(aligned_json)
+    if count <= split:
+        return job, count, None, None
+    pcm_path = segment_pcm_path(aligned_path)
+    duration = max(seg['end'] for seg in aligned_json) / 1000.0
+    timeout = wsupervise.timeout_for(sup, duration)
+    start = time.monotonic()
+    for attempt in range(sup['retries'] + 1):
+        wsupervise.wait_retry(sup, attempt)
+        try:
+            with wsupervise.deadline(timeout):
+                audio = (AudioSegment.from_file(audio_file)
+                         .set_channels(1)
+                         .set_frame_rate(16000))
+                with open(pcm_path + '.tmp', 'wb') as o:
+                    o.write(audio.raw_data)
+            os.replace(pcm_path + '.tmp', pcm_path)
+            break
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            logging.debug('[-] Decode {}: {} (attempt {})'.format(audio_file, error, attempt + 1))
+            try: os.unlink(pcm_path + '.tmp')
+            except Exception: pass
+    else:
+        fail = wsupervise.failure('segment', audio_file, error, attempt + 1, time.monotonic() - start, duration)
+        return job, count, None, fail
+    return job, count, (pcm_path, audio.sample_width), None
+
+def segment_parts(count, split, pcm):
+    """(index, first, last, pcm) segment ranges, one covering everything unless pcm is set."""
+    if pcm is None:
+        return [(0, 0, None, None)]
+    return [(k, lo, min(count, lo + split), pcm) for k, lo in enumerate(range(0, count, split))]
+
+def segment_planned(pool, jobs, split, threads, files):
+    """Yields segment() results, planning files a few at a time and submitting each file's
+    parts as soon as its plan returns, ahead of files not planned yet.
+
+    Fills `files` with each file's progress as it is planned. A file whose plan failed
+    yields a single result carrying the failure.
+    """
+    done = queue.Queue()
+    todo = list(reversed(jobs))
+    parts = []
+    inflight = 0
+    while todo or parts or inflight:
+        while (todo or parts) and inflight < threads * 2:
+            if parts:
+                # longest parts first, so the short ones fill in at the end
+                _, task = parts.pop()
+                pool.apply_async(segment, (task,),
+                    callback=lambda result: done.put(('segment', result)),
+                    error_callback=lambda e, task=task: done.put(('segment', (task[0], task[-1][0], [], 0.0, 0,
+                        wsupervise.failure('segment', task[0], '{}: {}'.format(type(e).__name__, e), 1), 0.0, 0.0))))
+            else:
+                job = todo.pop()
+                pool.apply_async(plan_segments, ((job, split),),
+                    callback=lambda result: done.put(('plan', result)),
+                    error_callback=lambda e, job=job: done.put(('plan', (job, 0, None,
+                        wsupervise.failure('segment', job[0], '{}: {}'.format(type(e).__name__, e), 1)))))
+            inflight += 1
+        kind, result = done.get()
+        inflight -= 1
+        if kind == 'segment':
+            yield result
+            continue
+        job, count, pcm, fail = result
+        file_parts = segment_parts(count, split, pcm)
+        files[job[0]] = {'parts': [None] * len(file_parts), 'left': len(file_parts), 'count': count, 'pcm': pcm,
+                         'removed': 0.0, 'skipped': 0, 'fail': None, 'elapsed': 0.0, 'duration': 0.0}
+        if fail is not None:
+            yield job[0], 0, [], 0.0, 0, fail, fail['elapsed'], fail['duration']
+            continue
+        for part in file_parts:
+            _, first, last, _ = part
+            parts.append((count if last is None else last - first, job + (part,)))
+        parts.sort(key=lambda t: t[0])
+
+def segment(args):
+    audio_file, aligned_path, txt_path, clips_dir, alphabet, post, sup, part = args
+    index, first, last, pcm = part
+    try:
+        with open(aligned_path, 'r') as f:
+            aligned_json = json.load(f)[first:last]
         with open(txt_path, 'r') as f:
             transcript = f.read()
     except Exception:
         logging.debug('[+] Clip not aligned: {}'.format(txt_path))
-        return []
+        return audio_file, index, [], 0.0, 0, wsupervise.failure('segment', audio_file, 'not aligned', 0), 0.0, 0.0
+
+    duration = max([seg['end'] for seg in aligned_json] + [0]) / 1000.0
+    if pcm is not None:
+        duration -= min(max(0, seg['start']) for seg in aligned_json) / 1000.0
+    timeout = wsupervise.timeout_for(sup, duration)
+    start = time.monotonic()
+    for attempt in range(sup['retries'] + 1):
+        wsupervise.wait_retry(sup, attempt)
+        try:
+            with wsupervise.deadline(timeout):
+                results, removed, skipped = segment_file(audio_file, aligned_json, first, transcript, clips_dir, alphabet, post, pcm)
+            break
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            logging.debug('[-] Segment {}: {} (attempt {})'.format(audio_file, error, attempt + 1))
+    else:
+        elapsed = time.monotonic() - start
+        fail = wsupervise.failure('segment', audio_file, error, attempt + 1, elapsed, duration)
+        return audio_file, index, [], 0.0, 0, fail, elapsed, duration
+    return audio_file, index, results, removed, skipped, None, time.monotonic() - start, duration
 
-    audio = (AudioSegment.from_file(audio_file)
-             .set_channels(1)
-             .set_frame_rate(16000))
-    for i, segment in enumerate(aligned_json):
+def load_span(pcm, start, end):
+    """The [start, end) ms span of a file decoded by plan_segments, and the file's length in ms."""
+    from pydub import AudioSegment
+    pcm_path, width = pcm
+    bytes_per_ms = 16 * width
+    total = os.path.getsize(pcm_path) // bytes_per_ms
+    start = min(int(start), total)
+    end = min(int(math.ceil(end)), total)
+    with open(pcm_path, 'rb') as f:
+        f.seek(start * bytes_per_ms)
+        data = f.read((end - start) * bytes_per_ms)
+    return AudioSegment(data=data, sample_width=width, frame_rate=16000, channels=1), start, total
+
+def segment_file(audio_file, aligned_json, first, transcript, clips_dir, alphabet, post, pcm=None):
+    """Exports the clips for `aligned_json`, the file's segments numbered from `first` on.
+
+    Returns (clip list lines, ms trimmed, segments skipped).
+    """
+    from pydub import AudioSegment
+    words_re = re.compile(alphabet)
+    name = os.path.basename(audio_file).split('.')[0]
+    skipped = 0
+    removed = 0.0
+    results = []
+
+    if pcm is None:
+        audio = (AudioSegment.from_file(audio_file)
+                 .set_channels(1)
+                 .set_frame_rate(16000))
+        offset, total = 0, len(audio)
+    else:
+        audio, offset, total = load_span(pcm,
+            min(max(0, seg['start']) for seg in aligned_json), max(seg['end'] for seg in aligned_json))
+    if post:
+        import waudio
+        audio = audio.set_sample_width(2)
+    for i, segment in enumerate(aligned_json, first):
         # TODO: use a g2p style normalizer to fix numbers? would probably want to do it pre alignment.
         # numbers are one of the main reasons for `aligned != aligned_raw`
         try:
             text = segment['aligned-raw']
             start = max(0, segment['start'])
             end   = segment['end']
-            if end > len(audio):
+            if end > total:
                 skipped += 1
                 continue
 
@@ -120,19 +319,102 @@ def segment(args):
 
             subname = '{}-{}'.format(name, i)
             clip = '{}/{}.flac'.format(clips_dir, subname)
-            if not os.path.exists(clip):
-                audio[start:end].export(clip, format='flac')
+            if post:
+                clip = '{}/{}.{}.flac'.format(clips_dir, subname, post['tag'])
             duration = round(end - start, 3)
+            piece = None
+            if post:
+                # trim edge silence and normalize, the clip duration follows the trimmed audio
+                x = waudio.samples(audio[start - offset:end - offset])
+                if post['trim']:
+                    a, b = waudio.trim_bounds(x, 16000, threshold_db=post['trim_db'], pad_ms=post['trim_pad'])
+                    x = x[a:b]
+                if post['normalize']:
+                    x = waudio.normalize(x, post['normalize'], post['norm_db'])
+                piece = AudioSegment(data=x.tobytes(), sample_width=2, frame_rate=16000, channels=1)
+                removed += duration - len(x) / 16.0
+                duration = round(len(x) / 16.0, 3)
+            if not os.path.exists(clip):
+                if piece is None:
+                    piece = audio[start - offset:end - offset]
+                # a deadline can fire mid-export, so a clip only appears once it is complete
+                piece.export(clip + '.tmp', format='flac')
+                os.replace(clip + '.tmp', clip)
             results.append('{} {} {} {}'.format(subname, clip, duration, text))
+        except TimeoutError:
+            raise
         except Exception:
             logging.debug('Error segmenting {}-{}'.format(name, i))
             skipped += 1
-    return results
+    return results, removed, skipped
+
+def align_ordered(pool, chains, jobs):
+    """Yields align results as they finish, submitting each chain's jobs one at a time.
+
+    A chapter is submitted once the chapter before it is aligned, so it always finds that
+    sibling's alignment, while other chains keep the pool busy. Up to `jobs` * 2 alignments
+    are in flight, and a finished chapter's successor goes ahead of chains not started yet.
+    """
+    done = queue.Queue()
+    ready = [(chain, 0) for chain in reversed(chains)]
+    inflight = 0
+    left = sum(len(chain) for chain in chains)
+    while left:
+        while ready and inflight < jobs * 2:
+            chain, i = ready.pop()
+            pool.apply_async(align, (chain[i],),
+                callback=lambda result, chain=chain, i=i: done.put((chain, i, result)),
+                error_callback=lambda e, chain=chain, i=i: done.put((chain, i, e)))
+            inflight += 1
+        chain, i, result = done.get()
+        inflight -= 1
+        left -= 1
+        if i + 1 < len(chain):
+            ready.append((chain, i + 1))
+        if isinstance(result, BaseException):
+            logging.debug('Failed to align {}: {}'.format(chain[i][1], result))
+            continue
+        yield result
+
+def chain_chapters(align_queue):
+    """One chain per shared transcript in chapter order, and one per other recording, largest first."""
+    chains = {}
+    for job in align_queue:
+        chapter = job[-1]
+        key = ('group', chapter['group']) if chapter is not None else ('file', job[1])
+        chains.setdefault(key, []).append(job)
+    for chain in chains.values():
+        chain.sort(key=lambda job: job[-1]['index'] if job[-1] is not None else 0)
+    return sorted(chains.values(), key=lambda chain: sum(job[0] for job in chain), reverse=True)
+
+def transcribe(align_queue, align_dir, model_dir, args, threads, report, quarantine):
+    """Runs STT for every file still missing its tlog through one shared service.
 
-    if skipped:
-        logging.debug('[-] Clip {}: skipped {}/{} segments due to bad alignment'.format(name, skipped, len(aligned_json)))
+    Returns the align jobs whose tlog is ready, failed files are reported and quarantined.
+    """
+    from tqdm import tqdm
+    todo = []
+    for job in align_queue:
+        name = input_name(job[1])
+        tlog = os.path.join(align_dir, name + '.tlog')
+        if not os.path.exists(os.path.join(align_dir, name + '-aligned.json')) and not os.path.exists(tlog):
+            todo.append((job[1], tlog))
+    if not todo:
+        return align_queue
+    workers = args.workers or threads
+    logging.info('[+] Transcribing ({}) file(s) with ({}) STT worker(s)'.format(len(todo), workers))
+    failed = set()
+    results = wstt.transcribe(todo, workers, args.jobs, backend=args.stt_backend,
+                              model_dir=model_dir or 'models/en', batch_size=args.stt_batch_size)
+    for audio_path, error in tqdm(results, desc='Transcribe', total=len(todo)):
+        if error is not None:
+            report.fail(wsupervise.failure('stt', audio_path, error, 1))
+            quarantine.add(input_name(audio_path))
+            failed.add(audio_path)
+    return [job for job in align_queue if job[1] not in failed]
 
 def wav2train(args):
+    from tqdm import tqdm
     logfile = os.path.abspath('align.log')
     logging.basicConfig(filename=logfile, level=logging.DEBUG)
     stream = logging.StreamHandler()
@@ -142,13 +424,20 @@ def wav2train(args):
 
     indir     = os.path.abspath(args.input_dir)
     outdir    = os.path.abspath(args.output_dir)
-    align_dir = os.path.join(outdir, 'align')
+    work_dir  = outdir
+    shard = None
+    if args.shard:
+        shard = wmerge.parse_shard(args.shard)
+        work_dir = wmerge.shard_dir(outdir, *shard)
+    align_dir = os.path.join(work_dir, 'align')
     clips_dir  = os.path.join(outdir, 'clips')
-    clips_lst = os.path.join(outdir, 'clips.lst')
+    clips_lst = os.path.join(work_dir, 'clips.lst')
 
     logging.info('[+] Starting new alignment.')
     logging.info('[+] Input: {}'.format(indir))
     logging.info('[+] Output: {}'.format(outdir))
+    if shard:
+        logging.info('[+] Shard: {}/{} -> {}'.format(shard[0], shard[1], work_dir))
 
     model_dir = None
     if args.model:
@@ -164,72 +453,197 @@ def wav2train(args):
     else:
         stt_jobs = max(1, threads // args.jobs)
 
+    sup = wsupervise.settings(args)
+    quarantine = wsupervise.Quarantine(work_dir)
+    report = wsupervise.Report(work_dir)
+    quarantined = []
     align_queue = []
-    align_args = (align_dir, stt_jobs, args.verbose, model_dir)
+    align_args = (align_dir, stt_jobs, args.verbose, model_dir, sup, args.batch_stt)
     logging.info('[+] Collecting files to align')
     seen_exts   = set()
     unseen_exts = {'flac', 'wav', 'mp3', 'm4a', 'ogg', 'sph', 'aac', 'wma', 'alac'}
-    for ent in os.scandir(indir):
-        if ent.name.endswith('.txt'):
-            txt_path = ent.path
-            name = txt_path.rsplit('.', 1)[0]
-            ext = ''
-            n_path = ''
-            # little dance to find the right file extension without doing way too many stats
-            for ext in seen_exts:
+    discovered = []
+    assigned = []
+    entries = [ent for ent in os.scandir(indir) if ent.name.endswith('.txt')]
+    if shard:
+        shard_keys = wmerge.shard_keys(entries)
+    for ent in entries:
+        txt_path = ent.path
+        name = txt_path.rsplit('.', 1)[0]
+        base = input_name(ent.name)
+        if shard:
+            discovered.append(base)
+            if wmerge.shard_of(shard_keys[base], shard[1]) != shard[0]:
+                continue
+            assigned.append(base)
+        ext = ''
+        n_path = ''
+        # little dance to find the right file extension without doing way too many stats
+        for ext in seen_exts:
+            n_ext = name + '.' + ext
+            n_path = os.path.join(indir, n_ext)
+            if os.path.exists(n_path):
+                break
+        else:
+            for ext in unseen_exts:
                 n_ext = name + '.' + ext
                 n_path = os.path.join(indir, n_ext)
                 if os.path.exists(n_path):
                     break
             else:
-                for ext in unseen_exts:
-                    n_ext = name + '.' + ext
-                    n_path = os.path.join(indir, n_ext)
-                    if os.path.exists(n_path):
-                        break
-                else:
-                    continue
-                seen_exts.add(ext)
-                unseen_exts.remove(ext)
-            sz = ent.stat(follow_symlinks=True).st_size
-            audio_path = n_path
-            align_queue.append((sz, audio_path, txt_path) + align_args)
+                continue
+            seen_exts.add(ext)
+            unseen_exts.remove(ext)
+        if base in quarantine:
+            quarantined.append(base)
+            if not args.retry_quarantined:
+                continue
+        sz = ent.stat(follow_symlinks=True).st_size
+        audio_path = n_path
+        align_queue.append((sz, audio_path, txt_path) + align_args + (None,))
+
+    if quarantined:
+        if args.retry_quarantined:
+            logging.info('[+] Retrying ({}) quarantined file(s)'.format(len(quarantined)))
+            quarantine.release(quarantined)
+        else:
+            logging.info('[-] Skipping ({}) quarantined file(s), see {}'.format(len(quarantined), quarantine.path))
+
+    if args.window:
+        chapters = wwindow.plan_chapters([(job[1], job[2]) for job in align_queue])
+        logging.info('[+] Windowing transcripts for ({}) chapter recording(s)'.format(len(chapters)))
+        align_queue = [job[:-1] + (chapters.get(job[1]),) for job in align_queue]
+
+    if shard:
+        wmerge.write_manifest(work_dir, shard[0], shard[1], assigned, discovered)
 
     align_queue.sort(reverse=True)
+    if args.batch_stt:
+        align_queue = transcribe(align_queue, align_dir, model_dir, args, threads, report, quarantine)
     segment_queue = []
-    chunksize = max(1, min(4, len(align_queue) // args.jobs))
+    post = None
+    if args.trim or args.normalize:
+        post = {'trim': args.trim, 'trim_db': args.trim_db, 'trim_pad': args.trim_pad,
+                'normalize': args.normalize, 'norm_db': args.norm_db}
+        # processed clips are named after their settings, so a clip exported with other settings is never reused
+        post['tag'] = hashlib.sha1(json.dumps(post, sort_keys=True).encode('utf8')).hexdigest()[:8]
     gc.collect()
     align_pool = Pool(args.jobs)
-    align_iter = align_pool.imap_unordered(align, align_queue, chunksize=chunksize)
+    align_iter = align_ordered(align_pool, chain_chapters(align_queue), args.jobs)
     logging.info('[+] Aligning ({}) transcript(s)'.format(len(align_queue)))
-    for audio_path, aligned_path, txt_path in tqdm(align_iter, desc='Align', total=len(align_queue)):
+    cached = []
+    for audio_path, aligned_path, txt_path, fail, elapsed, duration in tqdm(align_iter, desc='Align', total=len(align_queue)):
         try:
-            segment_queue.append((audio_path, aligned_path, txt_path, clips_dir, args.alphabet))
+            if elapsed:
+                report.time('align', audio_path, elapsed, duration)
+            if fail is not None:
+                report.fail(fail)
+                quarantine.add(input_name(audio_path))
+                continue
+            cache_path = None
+            if shard:
+                cache_path = aligned_path.rsplit('-aligned.json', 1)[0] + ('.{}.clips'.format(post['tag']) if post else '.clips')
+                if os.path.exists(cache_path):
+                    cached.append(cache_path)
+                    continue
+            segment_queue.append(((audio_path, aligned_path, txt_path, clips_dir, args.alphabet, post, sup), cache_path))
         except Exception:
             logging.debug('Failed to align {}'.format(audio_path))
     logging.info('[+] Alignment complete')
 
-    chunksize = max(1, min(4, len(segment_queue) // threads))
     gc.collect()
     segment_pool = Pool(threads)
-    segment_iter = segment_pool.imap_unordered(segment, segment_queue, chunksize=chunksize)
+    # files with many segments are split into parts, so one long recording can't hold up the end of the run
+    cache_paths = {job[0]: cache_path for job, cache_path in segment_queue}
+    files = {}
+    segment_iter = segment_planned(segment_pool, [job for job, _ in segment_queue], args.segment_split, threads, files)
     logging.info('[+] Generating segments for ({}) clip(s)'.format(len(segment_queue)))
+    progress = tqdm(desc='Segment', total=len(segment_queue))
+    removed = kept = 0.0
+    if cached:
+        logging.info('[+] Resuming: reusing segments for ({}) clip(s)'.format(len(cached)))
     with open(clips_lst, 'w') as lst:
-        for lines in tqdm(segment_iter, desc='Segment', total=len(segment_queue)):
+        for path in cached:
+            with open(path, 'r') as f:
+                lst.write(f.read())
+        for audio_path, index, lines, trimmed, skipped, fail, elapsed, duration in segment_iter:
+            info = files[audio_path]
+            info['parts'][index] = lines
+            info['removed'] += trimmed
+            info['skipped'] += skipped
+            info['elapsed'] += elapsed
+            info['duration'] += duration
+            if info['fail'] is None:
+                info['fail'] = fail
+            info['left'] -= 1
+            if info['left']:
+                continue
+            progress.update()
+            if info['pcm'] is not None:
+                try: os.unlink(info['pcm'][0])
+                except Exception: pass
+            if info['elapsed']:
+                report.time('segment', audio_path, info['elapsed'], info['duration'])
+            if info['fail'] is not None:
+                report.fail(info['fail'])
+                quarantine.add(input_name(audio_path))
+                continue
+            if info['skipped']:
+                logging.debug('[-] Clip {}: skipped {}/{} segments due to bad alignment'.format(
+                    input_name(audio_path), info['skipped'], info['count']))
+            lines = [line for part in info['parts'] for line in part]
+            cache_path = cache_paths[audio_path]
+            if cache_path is not None:
+                # lets a resumed shard skip this file
+                with open(cache_path + '.tmp', 'w') as o:
+                    o.write(''.join(line + '\n' for line in lines))
+                os.replace(cache_path + '.tmp', cache_path)
+            removed += info['removed']
             if lines:
+                kept += sum(float(line.split(' ', 3)[2]) for line in lines)
                 lst.write('\n'.join(lines) + '\n')
+    progress.close()
+    split = sum(1 for info in files.values() if len(info['parts']) > 1)
+    if split:
+        logging.info('[+] Segmented ({}) long clip(s) in parts'.format(split))
+    if args.trim:
+        hours = lambda ms: ms / 1000.0 / 60.0 / 60.0
+        logging.info('[+] Trimmed {:.3f} hours of silence ({:.1%}), {:.3f} hours of clips remain'.format(
+            hours(removed), removed / ((removed + kept) or 1), hours(kept)))
+    wbucket.reorder_file(clips_lst, args, desc='clips.lst', log=logging.info)
+    windex.build(clips_lst)
+    report.dump()
+    if shard:
+        wmerge.write_manifest(work_dir, shard[0], shard[1], assigned, discovered, done=True)
+        logging.info('[+] Shard {}/{} done, run wmerge {} once every shard has finished.'.format(shard[0], shard[1], outdir))
     logging.info('[+] Generated segments. All done.')
 
-if __name__ == '__main__':
+def main(argv=None):
     logging.getLogger('sox').setLevel(logging.ERROR)
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(prog='wav2train')
     parser.add_argument('input_dir')
     parser.add_argument('output_dir')
     parser.add_argument('--model',    '-m', help='directory containing speech model', type=str)
     parser.add_argument('--jobs',     '-j', help='alignments to run in parallel', type=int, default=1)
-    parser.add_argument('--workers',  '-w', help='number parallel transcription workers per job', type=int)
+    parser.add_argument('--workers',  '-w', help='number parallel transcription workers per job (in total with --batch-stt)', type=int)
     parser.add_argument('--verbose',  '-v', help='print verbose output', action='store_true')
+    parser.add_argument('--window',         help='narrow transcripts shared by several recordings (e.g. books) before aligning', action='store_true')
+    parser.add_argument('--batch-stt',      help='transcribe all files through one shared, batching STT service', action='store_true')
+    parser.add_argument('--stt-batch-size', help='speech fragments per STT batch with --batch-stt', type=int, default=wstt.default_batch_size)
+    parser.add_argument('--stt-backend',    help='STT model for --batch-stt (stub is for testing)', choices=sorted(wstt.backends), default='deepspeech')
     parser.add_argument('--alphabet',       help='constrain words to this alphabet (regex)', type=str, default="[a-zA-Z']+")
-    args = parser.parse_args()
+    parser.add_argument('--shard',          help='only process hash partition K of N inputs (K/N), for multi-node runs', type=str, default=None)
+    parser.add_argument('--segment-split',  help='split files with more segments than this across workers', type=int, default=500)
+    parser.add_argument('--trim',           help='trim leading and trailing silence from clips', action='store_true')
+    parser.add_argument('--trim-db',        help='silence threshold for --trim (dBFS)', type=float, default=-40.0)
+    parser.add_argument('--trim-pad',       help='silence to keep around speech for --trim (ms)', type=int, default=100)
+    parser.add_argument('--normalize',      help='normalize clip loudness', choices=('peak', 'rms'), default=None)
+    parser.add_argument('--norm-db',        help='normalization target (dBFS, default -1 peak / -20 rms)', type=float, default=None)
+    wbucket.add_arguments(parser)
+    wsupervise.add_arguments(parser)
+    args = parser.parse_args(argv)
     wav2train(args)
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,11 @@ from tempfile import NamedTemporaryFile
 import argparse
 import hashlib
 import os
-import subprocess
 import itertools
 
-from tqdm import tqdm
-
-base = os.path.dirname(__file__)
-wfilter = os.path.join(base, '..', 'wfilter')
+import wbucket
+import wfilter
+import wrebase
 
 def cache_one(args):
     line, cache_dir = args
@@ -29,7 +27,8 @@ def cache_one(args):
             o.write(data)
     return _id, cache_path, duration, text, length
 
-def batch_filter(outdir, set_name, lists, argv, merge=False, cache=None):
+def batch_filter(outdir, set_name, lists, argv, merge=False, cache=None, pool=None, order=None):
+    from tqdm import tqdm
     if not lists:
         return ''
     print('[+] {}'.format(set_name))
@@ -39,17 +38,19 @@ def batch_filter(outdir, set_name, lists, argv, merge=False, cache=None):
         with NamedTemporaryFile('w', suffix='.lst') as tmp:
             count = 0
             for lst in tqdm(lists, desc='copy lists'):
+                base_dir = os.path.dirname(os.path.abspath(lst))
                 with open(lst, 'r') as f:
-                    data = f.read().strip() + '\n'
+                    # the merged list lives elsewhere, so relative clip paths can't stay relative
+                    data = ''.join(wrebase.absolute_line(line, base_dir) + '\n' for line in f.read().strip().split('\n'))
                     count += data.count('\n')
                     tmp.write(data)
             tmp.flush()
             if cache is None:
                 with open(outlst, 'w') as out:
-                    subprocess.check_call([wfilter, tmp.name, '--desc', lstname] + argv, stdout=out)
+                    wfilter.main([tmp.name, '--desc', lstname, '--absolute'] + argv, out=out)
             else:
                 with NamedTemporaryFile('w+', suffix='.lst') as tmp2:
-                    subprocess.check_call([wfilter, tmp.name, '--desc', lstname] + argv, stdout=tmp2)
+                    wfilter.main([tmp.name, '--desc', lstname, '--absolute'] + argv, out=tmp2)
                     tmp2.seek(0, os.SEEK_END)
                     size = tmp2.tell()
                     tmp2.seek(0, os.SEEK_SET)
@@ -58,6 +59,7 @@ def batch_filter(outdir, set_name, lists, argv, merge=False, cache=None):
                         pool_iter = pool.imap(cache_one, zip(tmp2, itertools.repeat(cache)), chunksize=8)
                         for _id, path, duration, text, length in tqdm(pool_iter, desc='cache', total=count):
                             out.write(f"{_id} {path} {duration} {text}\n")
+        wbucket.reorder_file(outlst, order, desc=lstname)
         return lstname
 
     datadir = os.path.commonprefix(lists)
@@ -68,11 +70,13 @@ def batch_filter(outdir, set_name, lists, argv, merge=False, cache=None):
         names.append(lstname)
         outlst = os.path.join(outdir, lstname)
         with open(outlst, 'w') as out:
-            subprocess.check_call([wfilter, lst, '--desc', lstname] + argv, stdout=out)
+            wfilter.main([lst, '--desc', lstname, '--absolute'] + argv, out=out)
+        wbucket.reorder_file(outlst, order, desc=lstname)
     print()
     return ','.join(names)
 
-def main(args, argv):
+def batch(args, argv, pool=None):
+    from tqdm import tqdm
     flagsfile = os.path.realpath(args.flagsfile)
     outdir = os.path.realpath(args.output)
 
@@ -103,23 +107,29 @@ def main(args, argv):
                 except FileExistsError:
                     pass
 
-    flags['--train'] = batch_filter(outdir, 'train', train_set, argv, merge=args.merge, cache=args.cache)
-    flags['--test']  = batch_filter(outdir, 'test',  test_set,  argv, cache=args.cache)
-    flags['--valid'] = batch_filter(outdir, 'valid', valid_set, argv, cache=args.cache)
+    if args.batch_size is None and flags.get('--batchsize'):
+        args.batch_size = int(flags['--batchsize'])
+    flags['--train'] = batch_filter(outdir, 'train', train_set, argv, merge=args.merge, cache=args.cache, pool=pool, order=args)
+    flags['--test']  = batch_filter(outdir, 'test',  test_set,  argv, cache=args.cache, pool=pool)
+    flags['--valid'] = batch_filter(outdir, 'valid', valid_set, argv, cache=args.cache, pool=pool)
     flags['--datadir'] = outdir
 
     with open(os.path.join(outdir, 'flagsfile'), 'w') as f:
         for k, v in flags.items():
             f.write('{}={}\n'.format(k, v))
 
-if __name__ == '__main__':
-    pool = Pool()
-
-    parser = argparse.ArgumentParser()
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wbatch')
     parser.add_argument('--flagsfile', help='input flagsfile path', type=str, required=True)
     parser.add_argument('--output',    help='output directory', type=str, required=True)
     parser.add_argument('--merge',     help='merge train into one list', action='store_true')
     parser.add_argument('--cache',     help='cache audio to this directory', type=str, default=None)
+    # batch size defaults to --batchsize from the flagsfile
+    wbucket.add_arguments(parser)
 
-    args, unknown = parser.parse_known_args()
-    main(args, unknown)
+    args, unknown = parser.parse_known_args(argv)
+    with Pool() as pool:
+        batch(args, unknown, pool=pool)
+
+if __name__ == '__main__':
+    main()
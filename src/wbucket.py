@@ -0,0 +1,81 @@
+import bisect
+import random
+
+# Reorders w2l lists so each batch holds clips of similar length.
+# wav2letter batches clips in list order, so mixed lengths mostly train on padding.
+
+orders = ('none', 'sorted', 'bucket')
+default_buckets = '1000,2000,4000,6000,8000,10000,15000,20000,30000'
+default_batch_size = 8
+
+def add_arguments(parser):
+    parser.add_argument('--order',      help='list order: none, sorted (by duration) or bucket (shuffled within duration buckets)',
+                        choices=orders, default='none')
+    parser.add_argument('--buckets',    help='bucket boundaries in ms, comma separated', type=str, default=default_buckets)
+    parser.add_argument('--batch-size', help='training batch size, to estimate padding and keep batches aligned', type=int, default=None)
+
+def duration(line):
+    try:
+        return float(line.split(None, 3)[2])
+    except (IndexError, ValueError):
+        return 0.0
+
+def padding_ratio(durations, batch_size):
+    """Fraction of batched audio that is padding, if batches are taken in list order."""
+    padded = total = 0.0
+    for i in range(0, len(durations), batch_size):
+        batch = durations[i:i + batch_size]
+        longest = max(batch)
+        padded += longest * len(batch)
+        total += sum(batch)
+    if not padded:
+        return 0.0
+    return (padded - total) / padded
+
+def order_lines(lines, order='bucket', buckets=default_buckets, batch_size=default_batch_size, seed=None):
+    """Returns `lines` sorted by duration, or bucketed by duration.
+
+    Bucketed lists are shuffled within each bucket and cut into batches, then the full batches
+    are shuffled together so training still sees every length throughout an epoch. Partial
+    batches go last, so every full batch stays aligned to a multiple of batch_size.
+    """
+    if order == 'none':
+        return list(lines)
+    if order == 'sorted':
+        return sorted(lines, key=duration)
+    rng = random.Random(seed)
+    bounds = sorted(float(b) for b in buckets.split(',') if b.strip())
+    groups = [[] for _ in range(len(bounds) + 1)]
+    for line in lines:
+        groups[bisect.bisect_right(bounds, duration(line))].append(line)
+    batches = []
+    leftover = []
+    for group in groups:
+        rng.shuffle(group)
+        full = len(group) - len(group) % batch_size
+        batches += [group[i:i + batch_size] for i in range(0, full, batch_size)]
+        leftover += group[full:]
+    rng.shuffle(batches)
+    leftover.sort(key=duration)
+    return [line for batch in batches for line in batch] + leftover
+
+def reorder(lines, args, desc='', log=print):
+    """Orders lines per the --order/--buckets/--batch-size args and prints the padding estimate."""
+    if args.order == 'none':
+        return lines
+    batch_size = args.batch_size or default_batch_size
+    before = padding_ratio([duration(line) for line in lines], batch_size)
+    lines = order_lines(lines, order=args.order, buckets=args.buckets, batch_size=batch_size)
+    after = padding_ratio([duration(line) for line in lines], batch_size)
+    log('[+] {}{} order: padding {:.1%} -> {:.1%} (batch size {})'.format(
+        desc + ' ' if desc else '', args.order, before, after, batch_size))
+    return lines
+
+def reorder_file(path, args, desc='', log=print):
+    if args is None or args.order == 'none':
+        return
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    lines = reorder(lines, args, desc=desc, log=log)
+    with open(path, 'w') as o:
+        o.write(''.join(line + '\n' for line in lines))
@@ -0,0 +1,55 @@
+from typing import Optional
+import hashlib
+import os
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class LexiconCache:
+    """Persistent word -> spellings cache for lexicon generation.
+
+    Entries live in <cache_dir>/<hash of settings>.tsv, so changing any generation
+    setting (--ctc, the sentencepiece model, nbest...) starts a separate cache.
+    Each line is `key<TAB>spelling[<TAB>spelling...]`, and new entries are appended.
+    """
+    def __init__(self, cache_dir: str, settings: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = hashlib.sha256(settings.encode('utf8')).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, digest + '.tsv')
+        self.entries = {}
+        self.new = {}
+        self.hits = 0
+        if os.path.exists(self.path):
+            good = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    good += len(line)
+                    key, *spellings = line[:-1].decode('utf8').split('\t')
+                    self.entries[key] = spellings
+            # an interrupted append leaves a partial last line, drop it
+            if good != os.path.getsize(self.path):
+                os.truncate(self.path, good)
+
+    def get(self, key: str) -> Optional[list[str]]:
+        spellings = self.entries.get(key)
+        if spellings is not None:
+            self.hits += 1
+        return spellings
+
+    def put(self, key: str, spellings: list[str]) -> None:
+        self.entries[key] = spellings
+        self.new[key] = spellings
+
+    def save(self) -> None:
+        if not self.new:
+            return
+        with open(self.path, 'a', encoding='utf8') as o:
+            for key, spellings in self.new.items():
+                o.write('\t'.join([key] + spellings) + '\n')
+        self.new = {}
@@ -0,0 +1,62 @@
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+tools = ('wav2train', 'wbatch', 'wfilter', 'windex', 'wlexicon', 'wmerge', 'wpiece', 'wplay', 'wrebase', 'wsplit', 'wstat')
+# wav2letter parallelization works better with this flag
+omp_tools = ('wav2train', 'wbatch', 'wfilter')
+# cold start budget per tool, in milliseconds on top of a bare interpreter
+startup_target = 100
+
+srcdir = os.path.dirname(os.path.abspath(__file__))
+
+def run(tool, *argv):
+    """Run a tool in this process, e.g. run('wsplit', 'output/clips.lst')."""
+    if tool not in tools:
+        raise ValueError('unknown tool: {}'.format(tool))
+    if tool in omp_tools:
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
+    module = importlib.import_module(tool)
+    return module.main(list(argv))
+
+def startup_times(repeat=5):
+    """Best-of-`repeat` wall time to start an interpreter and import each tool, minus a bare interpreter."""
+    def best(code):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', code], cwd=srcdir)
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+    base = best('pass')
+    return {tool: best('import {}'.format(tool)) - base for tool in tools}
+
+def usage():
+    print('Usage: w <tool> [args...]')
+    print('       w --startup    measure tool cold start against the {}ms target'.format(startup_target))
+    print('Tools: {}'.format(' '.join(tools)))
+    sys.exit(1)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        usage()
+    if argv[0] == '--startup':
+        slow = []
+        for tool, ms in startup_times().items():
+            print('{:10} {:6.1f}ms'.format(tool, ms))
+            if ms > startup_target:
+                slow.append(tool)
+        if slow:
+            print('[-] over {}ms target: {}'.format(startup_target, ' '.join(slow)))
+            sys.exit(1)
+        return
+    if argv[0] not in tools:
+        usage()
+    run(argv[0], *argv[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from collections import Counter
+from multiprocessing import Pool
+import os
+
+shard_bytes = 64 * 1024 * 1024
+
+def list_text(line: str) -> str:
+    return line.split(' ', 3)[-1].strip()
+
+def shards(paths: list[str], mode: str) -> list[tuple[str, str, int, int]]:
+    # split large files into byte ranges, each line belongs to the shard its first byte falls in
+    out = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), shard_bytes):
+            out.append((path, mode, start, min(size, start + shard_bytes)))
+    return out
+
+def count_shard(shard: tuple[str, str, int, int]) -> Counter:
+    path, mode, start, end = shard
+    counts = Counter()
+    with open(path, 'rb') as f:
+        if start > 0:
+            # finish the line that straddles the boundary, the previous shard owns it
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            line = line.decode('utf8')
+            if mode == 'list':
+                counts.update(list_text(line).split())
+            else:
+                # TODO: use an alphabet whitelist like wav2train?
+                counts.update(line.lower().split())
+    return counts
+
+def count_words(lists: list[str]=(), corpora: list[str]=(), jobs: int=None) -> Counter:
+    """Count word frequencies in the transcripts of w2l lists and in plain text corpora.
+
+    Words from text corpora are lowercased, list transcripts are used as-is.
+    """
+    queue = shards(lists, 'list') + shards(corpora, 'text')
+    counts = Counter()
+    if len(queue) <= 1 or jobs == 1:
+        for shard in queue:
+            counts.update(count_shard(shard))
+        return counts
+    with Pool(jobs) as pool:
+        # ordered merge so word order matches a serial scan
+        for shard_counts in pool.imap(count_shard, queue):
+            counts.update(shard_counts)
+    return counts
+
+def prune_words(counts: Counter, min_count: int=1, max_words: int=None) -> Counter:
+    """Drop words seen fewer than min_count times, and keep at most max_words of the most frequent."""
+    if min_count > 1:
+        counts = Counter({word: n for word, n in counts.items() if n >= min_count})
+    if max_words is not None and len(counts) > max_words:
+        counts = Counter(dict(counts.most_common(max_words)))
+    return counts
@@ -1,8 +1,7 @@
 import multiprocessing as mp
 from tempfile import NamedTemporaryFile
-from tqdm import tqdm
+from functools import partial
 import argparse
-import cffi
 import itertools
 import math
 import os
@@ -10,11 +9,29 @@ import re
 import subprocess
 import sys
 
+import windex
+import wrebase
+
 # start miniflac
-flac_ffi = cffi.FFI()
-flac_ffi.cdef(r'''
+flac_ffi = flac_lib = None
+miniflac_stream_read = miniflac_stream_error = None
+# set while a file's samples are being kept: [bits per sample, sample buffers]
+miniflac_keep = None
+
+def miniflac_load():
+    # cffi and libFLAC are only loaded the first time a flac is validated
+    global flac_ffi, flac_lib, miniflac_stream_read, miniflac_stream_error
+    if flac_ffi is not None:
+        return flac_lib
+    import cffi
+    flac_ffi = cffi.FFI()
+    flac_ffi.cdef(r'''
 typedef struct {
     uint32_t blocksize;
+    uint32_t sample_rate;
+    uint32_t channels;
+    int channel_assignment;
+    uint32_t bits_per_sample;
 } FLAC__FrameHeader;
 
 void *FLAC__stream_decoder_new();
@@ -32,23 +49,33 @@ uint32_t FLAC__stream_decoder_get_sample_rate(void *);
 uint32_t FLAC__stream_decoder_get_channels(void *);
 uint32_t FLAC__stream_encoder_get_state(void *);
 ''')
-try:
-    flac_lib = flac_ffi.dlopen('libFLAC.so')
-except Exception:
-    flac_lib = None
-
-@flac_ffi.callback('int (void *, FLAC__FrameHeader *, void *, size_t *)')
-def miniflac_stream_read(decoder, frame, buf, samples_out):
-    samples_out[0] += frame.blocksize
-    return 0
-
-@flac_ffi.callback('void ()')
-def miniflac_stream_error():
-    return 0
-
-def miniflac_read_file(path):
+    try:
+        flac_lib = flac_ffi.dlopen('libFLAC.so')
+    except Exception:
+        flac_lib = None
+
+    @flac_ffi.callback('int (void *, FLAC__FrameHeader *, int32_t **, size_t *)')
+    def stream_read(decoder, frame, buf, samples_out):
+        samples_out[0] += frame.blocksize
+        if miniflac_keep is not None:
+            miniflac_keep[0] = frame.bits_per_sample
+            miniflac_keep[1].append(flac_ffi.buffer(buf[0], frame.blocksize * 4)[:])
+        return 0
+
+    @flac_ffi.callback('void ()')
+    def stream_error():
+        return 0
+
+    miniflac_stream_read, miniflac_stream_error = stream_read, stream_error
+    return flac_lib
+
+def miniflac_read_file(path, keep_samples=False):
+    """Returns (seconds, channels, sample rate, first channel's int16 samples if keep_samples)."""
+    global miniflac_keep
     sample_count = flac_ffi.new('size_t *')
     decoder = flac_lib.FLAC__stream_decoder_new()
+    if keep_samples:
+        miniflac_keep = [16, []]
     try:
         status = flac_lib.FLAC__stream_decoder_init_file(
                 decoder, path.encode('utf8'), miniflac_stream_read, flac_ffi.NULL, miniflac_stream_error, sample_count)
@@ -59,8 +86,15 @@ def miniflac_read_file(path):
             raise RuntimeError('FLAC decode failed')
         sample_rate = flac_lib.FLAC__stream_decoder_get_sample_rate(decoder)
         channels    = flac_lib.FLAC__stream_decoder_get_channels(decoder)
-        return sample_count[0] / sample_rate, channels
+        samples = None
+        if keep_samples:
+            import numpy as np
+            import waudio
+            bits, chunks = miniflac_keep
+            samples = waudio.to_int16(np.frombuffer(b''.join(chunks), dtype=np.int32), bits)
+        return sample_count[0] / sample_rate, channels, sample_rate, samples
     finally:
+        miniflac_keep = None
         flac_lib.FLAC__stream_decoder_delete(decoder)
 # end miniflac
 
@@ -70,19 +104,44 @@ def srange(desc):
     rmin, rmax = map(int, desc.split('-', 1))
     return range(rmin, rmax+1)
 
-def valid_audio_fn(line):
+def frange(desc):
+    rmin, rmax = map(float, desc.split('-', 1))
+    return rmin, rmax
+
+def decode_samples(path, rate=16000):
+    import numpy as np
+    argv = ['ffmpeg', '-v', 'quiet', '-i', path, '-f', 's16le', '-ac', '1', '-ar', str(rate), '-']
+    out = subprocess.check_output(argv, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return np.frombuffer(out, dtype=np.int16)
+
+def quality_check(x, rate, quality):
+    """Name of the first signal check the clip fails, or None."""
+    import waudio
+    if quality['clipping'] is not None and waudio.clip_ratio(x) > quality['clipping']:
+        return 'clipping'
+    if quality['rms'] is not None and waudio.rms_db(x) < quality['rms']:
+        return 'rms'
+    if quality['silence'] is not None and waudio.silence_ratio(x, rate, quality['silence_db']) > quality['silence']:
+        return 'silence'
+    return None
+
+def valid_audio_fn(line, quality=None, base_dir=''):
+    """Returns (line, None) for a valid clip, or (line, name of the failed check)."""
     parts = line.split(' ', 3)
     if len(parts) != 4:
-        return
-    path = parts[1]
+        return line, 'valid'
+    # relative clip paths are relative to the list
+    path = os.path.join(base_dir, parts[1])
+    samples = None
+    rate = 16000
     try:
         # double check flacs
         is_flac = path.endswith('.flac')
-        if is_flac and flac_lib:
-            length, channels = miniflac_read_file(path)
+        if is_flac and miniflac_load():
+            length, channels, rate, samples = miniflac_read_file(path, keep_samples=quality is not None)
             length *= 1000
             if channels != 1:
-                return None
+                return line, 'valid'
         elif is_flac:
             subprocess.check_call(['flac', '-ts', path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             out = subprocess.check_output(['metaflac', '--show-total-samples', '--show-sample-rate', path])
@@ -93,12 +152,17 @@ def valid_audio_fn(line):
             p = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             out, err = p.communicate()
             length = float(out.strip()) * 1000
+        if quality is not None and samples is None:
+            rate = 16000
+            samples = decode_samples(path, rate)
     except Exception:
-        return None
+        return line, 'valid'
     # TODO: reltol vs abstol?
-    if length > 1.0 and abs(length - float(parts[2])) < 100.0:
-        return line
-    return None
+    if not (length > 1.0 and abs(length - float(parts[2])) < 100.0):
+        return line, 'valid'
+    if quality is not None:
+        return line, quality_check(samples, rate, quality)
+    return line, None
 
 def filter_lines(lines):
     return (line for line in lines
@@ -110,6 +174,14 @@ def filter_audio_length(lines, audio_range):
         if audio_length in audio_range:
             yield line
 
+def filter_speaking_rate(lines, rate_range):
+    rmin, rmax = rate_range
+    for line in lines:
+        _, _, length, text = line.split(' ', 3)
+        length = float(length)
+        if length > 0 and rmin <= len(text) * 1000 / length <= rmax:
+            yield line
+
 def filter_char_length(lines, char_range):
     for line in lines:
         text = line.split(' ', 3)[3]
@@ -122,13 +194,12 @@ def filter_regex(lines, regex):
         if regex.match(text):
             yield line
 
-def filter_valid_audio(lines):
-    pool = mp.Pool()
-    for line in pool.imap(valid_audio_fn, lines):
-        if line:
-            yield line
+def filter_valid_audio(lines, quality=None, base_dir=''):
+    """Yields (line, failed check or None), signal quality is measured in the same decode."""
+    with mp.Pool() as pool:
+        yield from pool.imap(partial(valid_audio_fn, quality=quality, base_dir=base_dir), lines)
 
-def filter_test_worker(n, args, lines, q):
+def filter_test_worker(n, args, lines, q, base_dir=''):
     lookup = {}
     for line in lines:
         try:
@@ -138,7 +209,8 @@ def filter_test_worker(n, args, lines, q):
         lookup[name] = line
 
     with NamedTemporaryFile('w', suffix='.txt') as lexicon, NamedTemporaryFile('w', suffix='.lst') as tmp_lst:
-        tmp_lst.write('\n'.join(lines) + '\n')
+        # Test resolves clip paths against its own cwd, not the list's directory
+        tmp_lst.write('\n'.join(wrebase.absolute_line(line, base_dir) for line in lines) + '\n')
         tmp_lst.flush()
 
         env = os.environ.copy()
@@ -154,7 +226,9 @@ def filter_test_worker(n, args, lines, q):
                 if line.startswith('[sample:'):
                     yield line
 
+        sent = 0
         for line in sample_iter():
+            sent += 1
             parts = line.split(' ')
             WER = float(parts[3].strip(',%')) / 100
             TER = float(parts[5].strip(',%')) / 100
@@ -164,8 +238,13 @@ def filter_test_worker(n, args, lines, q):
                     q.put(lookup[name])
                     continue
             q.put(None)
+        p.wait()
+        # samples Test skipped (e.g. clips it couldn't load) still count, or the reader would wait forever
+        for _ in range(len(lines) - sent):
+            q.put(None)
 
-def filter_test(args, lines, desc):
+def filter_test(args, lines, desc, base_dir=''):
+    from tqdm import tqdm
     manager = mp.Manager()
     q = manager.Queue()
     chunk_size = len(lines) // args.jobs
@@ -175,7 +254,7 @@ def filter_test(args, lines, desc):
                   for i in range(args.jobs)]
     with mp.Pool(args.jobs) as pool:
         for i, chunk in enumerate(chunks):
-            pool.apply_async(filter_test_worker, (i, args, chunk, q), error_callback=lambda exc: print(exc, file=sys.stderr))
+            pool.apply_async(filter_test_worker, (i, args, chunk, q, base_dir), error_callback=lambda exc: print(exc, file=sys.stderr))
 
         for i in tqdm(range(len(lines)), desc=f"{desc} (w2l)"):
             line = q.get()
@@ -202,6 +281,27 @@ class Stats:
             self.counts[name] = n
         return wrapper(lines)
 
+    def wrap_checks(self, names, results):
+        """Like wrap, for a pass running several checks over (line, failed check or None) pairs."""
+        self.order += names
+        def wrapper(results):
+            n = 0
+            failed = dict.fromkeys(names, 0)
+            for line, check in results:
+                n += 1
+                if check is None:
+                    yield line
+                else:
+                    failed[check] += 1
+            for name in names:
+                n -= failed[name]
+                self.counts[name] = n
+        return wrapper(results)
+
+    def record(self, name, count):
+        self.order.append(name)
+        self.counts[name] = count
+
     def line(self, line):
         name, path, length, text = line.split(' ', 3)
         wcount = text.count(' ') + 1 if text else 0
@@ -230,55 +330,92 @@ class Stats:
         word_stats = 'words (min={} max={})'.format(self.minwsz, self.maxwsz)
         eprint('| stats:    {} {} {}'.format(audio_stats, char_stats, word_stats))
 
-def wfilter(args):
+def wfilter(args, out=None):
+    from tqdm import tqdm
+    if out is None:
+        out = sys.stdout
     w2l_args = (args.w2l_test, args.am)
     w2l_fargs = (args.LER, args.WER)
     if any(w2l_args + w2l_fargs) and not (all(w2l_args) and any(w2l_fargs)):
         raise ValueError('Must provide all of (--w2l_test --am) and at least one of (--LER --WER)')
 
-    with open(args.lst, 'r') as f:
-        lines = f.read().strip().split('\n')
-    total = len(lines)
-    lines = filter_lines(lines)
-
-    stats = Stats(total)
-    if args.audio:
-        audio_range = srange(args.audio)
-        lines = filter_audio_length(lines, audio_range)
-        lines = stats.wrap('audio', lines)
-
-    if args.chars:
-        chars_range = srange(args.chars)
-        lines = filter_char_length(lines, chars_range)
-        lines = stats.wrap('chars', lines)
+    base_dir = os.path.dirname(os.path.abspath(args.lst))
+    # with a fresh sidecar index, length filters run on its arrays and only matching lines are read
+    idx = windex.load(args.lst) if (args.audio or args.chars or args.rate) else None
+    if idx is not None:
+        total = len(idx)
+        stats = Stats(total)
+        keep = idx.valid()
+        if args.audio:
+            audio_range = srange(args.audio)
+            keep = [i for i in keep if int(idx.durations[i]) in audio_range]
+            stats.record('audio', len(keep))
+        if args.chars:
+            chars_range = srange(args.chars)
+            keep = [i for i in keep if idx.text_lens[i] in chars_range]
+            stats.record('chars', len(keep))
+        if args.rate:
+            rmin, rmax = frange(args.rate)
+            keep = [i for i in keep if idx.durations[i] > 0 and rmin <= idx.text_lens[i] * 1000 / idx.durations[i] <= rmax]
+            stats.record('rate', len(keep))
+        lines = idx.lines(keep)
+    else:
+        with open(args.lst, 'r') as f:
+            lines = f.read().strip().split('\n')
+        total = len(lines)
+        lines = filter_lines(lines)
+
+        stats = Stats(total)
+        if args.audio:
+            audio_range = srange(args.audio)
+            lines = filter_audio_length(lines, audio_range)
+            lines = stats.wrap('audio', lines)
+
+        if args.chars:
+            chars_range = srange(args.chars)
+            lines = filter_char_length(lines, chars_range)
+            lines = stats.wrap('chars', lines)
+
+        if args.rate:
+            lines = filter_speaking_rate(lines, frange(args.rate))
+            lines = stats.wrap('rate', lines)
 
     if args.regex:
         regex = re.compile(args.regex) if args.regex else re.compile(r'')
         lines = filter_regex(lines, regex)
         lines = stats.wrap('regex', lines)
 
-    if args.valid:
-        lines = filter_valid_audio(lines)
-        lines = stats.wrap('valid', lines)
+    quality = None
+    if any(x is not None for x in (args.clipping, args.rms, args.silence)):
+        quality = {'clipping': args.clipping, 'rms': args.rms, 'silence': args.silence, 'silence_db': args.silence_db}
+    if args.valid or quality:
+        checks = ['valid'] + [name for name in ('clipping', 'rms', 'silence') if quality and quality[name] is not None]
+        lines = filter_valid_audio(lines, quality, base_dir=base_dir)
+        lines = stats.wrap_checks(checks, lines)
 
     line_iter = tqdm(lines, desc=args.desc, total=total)
     if all(w2l_args):
         lines = list(line_iter)
-        line_iter = filter_test(args, lines, args.desc)
+        line_iter = filter_test(args, lines, args.desc, base_dir=base_dir)
         line_iter = stats.wrap('w2l_test', line_iter)
 
     for line in line_iter:
-        print(line)
+        if args.absolute:
+            line = wrebase.absolute_line(line, base_dir)
+        out.write(line + '\n')
         stats.line(line)
 
     stats.dump()
+    if idx is not None:
+        idx.close()
 
-if __name__ == '__main__':
+def main(argv=None, out=None):
     example = '''
     Example: wfilter clips.lst --valid --audio 35-33000 --chars 1-600 > clips-filter.lst
+    Example: wfilter clips.lst --rate 5-30 --clipping 0.001 --rms -45 --silence 0.6 > clips-filter.lst
     Example: wfilter clips.lst --w2l_test ~/wav2letter/build/Test --am acoustic.bin --tokens tokens.txt --LER 0.5 > clips-filter.lst
     '''.rstrip()
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(prog='wfilter')
     parser.add_argument('lst',        help='input lst dataset file', type=str)
     parser.add_argument('--w2l_test', help='path to wav2letter Test binary', type=str)
     parser.add_argument('--am',       help='path to wav2letter acoustic model', type=str)
@@ -289,11 +426,20 @@ if __name__ == '__main__':
     parser.add_argument('--audio',    help='filter on audio length range (range MIN-MAX milliseconds)', type=str)
     parser.add_argument('--chars',    help='filter on char count (range MIN-MAX chars)', type=str)
     parser.add_argument('--regex',    help="filter transcripts not matching regex e.g. --transcript \"^[a-zA-Z' ]+$\"", type=str)
+    parser.add_argument('--rate',     help='filter on speaking rate (range MIN-MAX chars per second)', type=str)
     parser.add_argument('--valid',    help='filter broken audio files', action='store_true')
+    parser.add_argument('--clipping', help='filter clips with more than this fraction of samples at full scale (implies --valid)', type=float)
+    parser.add_argument('--rms',      help='filter clips quieter than this RMS level in dBFS (implies --valid)', type=float)
+    parser.add_argument('--silence',  help='filter clips with more than this fraction of silent 10ms frames (implies --valid)', type=float)
+    parser.add_argument('--silence-db', help='silence threshold for --silence (dBFS)', type=float, default=-40.0)
+    parser.add_argument('--absolute', help='write clip paths relative to the list (wrebase --relative) as absolute paths', action='store_true')
     parser.add_argument('--jobs', '-j', help='parallel jobs', type=int, default=1)
     try:
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
     except SystemExit:
         print(example, file=sys.stderr)
         raise
-    wfilter(args)
+    wfilter(args, out=out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import array
+import math
+import mmap
+import os
+import struct
+import sys
+
+# Sidecar index for a w2l list, stored as <list>.idx
+#
+# header:   magic, version, list size, list mtime_ns, line count, prefix count, prefix table bytes
+# arrays:   u64 offsets[count + 1]  byte offset of each line, plus the end of the last line
+#           f64 durations[count]    milliseconds, NaN for malformed lines
+#           u32 text_lens[count]    transcript length in characters
+#           u32 words[count]        transcript word count
+#           u32 prefixes[count]     index into the prefix table (directory of the clip path)
+# prefixes: the distinct clip directories, utf8, newline separated
+#
+# Everything is in native byte order, a foreign index fails the version check and is rebuilt.
+
+magic = b'WIDX'
+version = 1
+header = struct.Struct('=4sIQqQII')
+
+class StaleIndex(Exception):
+    pass
+
+def index_path(lst):
+    return lst + '.idx'
+
+def parse(line):
+    """(duration, text, prefix) of a list line as bytes. The duration is NaN for a malformed line."""
+    parts = line.rstrip(b'\r\n').split(b' ', 3)
+    if len(parts) != 4:
+        return math.nan, b'', b''
+    prefix = parts[1].rsplit(b'/', 1)[0] if b'/' in parts[1] else b''
+    try:
+        return float(parts[2]), parts[3], prefix
+    except ValueError:
+        return math.nan, parts[3], prefix
+
+def well_formed(line):
+    duration = parse(line)[0]
+    return duration == duration
+
+def pack(lst):
+    """Parse `lst` once and return its index as bytes."""
+    st = os.stat(lst)
+    offsets = array.array('Q')
+    durations = array.array('d')
+    text_lens = array.array('I')
+    words = array.array('I')
+    prefixes = array.array('I')
+    prefix_ids = {}
+    pos = 0
+    with open(lst, 'rb') as f:
+        for line in f:
+            offsets.append(pos)
+            pos += len(line)
+            duration, text, prefix = parse(line)
+            durations.append(duration)
+            text_lens.append(len(text.decode('utf8', 'replace')))
+            words.append(text.count(b' ') + 1 if text else 0)
+            prefixes.append(prefix_ids.setdefault(prefix, len(prefix_ids)))
+    offsets.append(pos)
+    table = b'\n'.join(prefix_ids)
+    head = header.pack(magic, version, st.st_size, st.st_mtime_ns, len(durations), len(prefix_ids), len(table))
+    return b''.join([head] + [arr.tobytes() for arr in (offsets, durations, text_lens, words, prefixes)] + [table])
+
+def build(lst):
+    """Parse `lst` once and write its sidecar index, returns the index path."""
+    data = pack(lst)
+    path = index_path(lst)
+    tmp = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+    with open(tmp, 'wb') as o:
+        o.write(data)
+    os.replace(tmp, path)
+    return path
+
+class ListIndex:
+    """Memory-mapped view of a list's sidecar index, or of an index packed in memory (`data`).
+    Arrays are zero-copy memoryviews."""
+    def __init__(self, lst, data=None):
+        self.lst = lst
+        self.list_file = None
+        self.mm = None
+        st = os.stat(lst)
+        if data is None:
+            with open(index_path(lst), 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self.mm
+        try:
+            fields = header.unpack_from(data, 0)
+        except struct.error:
+            self.close()
+            raise StaleIndex(lst)
+        _magic, _version, size, mtime_ns, count, nprefix, table_len = fields
+        if (_magic, _version) != (magic, version) or (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+            self.close()
+            raise StaleIndex(lst)
+        self.count = count
+        self.view = view = memoryview(data)
+        pos = header.size
+        def take(fmt, n):
+            nonlocal pos
+            width = struct.calcsize(fmt)
+            arr = view[pos:pos + width * n].cast(fmt)
+            pos += width * n
+            return arr
+        self.offsets   = take('Q', count + 1)
+        self.durations = take('d', count)
+        self.text_lens = take('I', count)
+        self.words     = take('I', count)
+        self.prefixes  = take('I', count)
+        table = bytes(view[pos:pos + table_len])
+        self.prefix_table = [p.decode('utf8') for p in table.split(b'\n')] if nprefix else []
+
+    def __len__(self):
+        return self.count
+
+    def line(self, i):
+        """Read line `i` (without the newline) straight from the list."""
+        if self.list_file is None:
+            self.list_file = open(self.lst, 'rb')
+        start, end = self.offsets[i], self.offsets[i + 1]
+        self.list_file.seek(start)
+        return self.list_file.read(end - start).rstrip(b'\r\n').decode('utf8')
+
+    def lines(self, indices):
+        for i in indices:
+            yield self.line(i)
+
+    def prefix(self, i):
+        return self.prefix_table[self.prefixes[i]]
+
+    def valid(self):
+        """Indices of well-formed lines."""
+        return [i for i, d in enumerate(self.durations) if d == d]
+
+    def close(self):
+        if self.list_file is not None:
+            self.list_file.close()
+            self.list_file = None
+        if self.mm is not None:
+            # the mapping can only close once nothing views it
+            for name in ('offsets', 'durations', 'text_lens', 'words', 'prefixes', 'view'):
+                arr = self.__dict__.pop(name, None)
+                if arr is not None:
+                    arr.release()
+            self.mm.close()
+            self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load(lst, build_missing=False):
+    """Returns a fresh ListIndex for `lst`, or None if there is none (and build_missing is False).
+
+    If the index can't be written next to the list (e.g. a read-only dataset), it is built in memory.
+    """
+    try:
+        return ListIndex(lst)
+    except (FileNotFoundError, StaleIndex, ValueError):
+        if not build_missing:
+            return None
+    try:
+        build(lst)
+    except OSError:
+        return ListIndex(lst, data=pack(lst))
+    return ListIndex(lst)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        print('Usage: windex <clips.lst> [clips.lst...]')
+        sys.exit(1)
+    for lst in argv:
+        print('[+] {}'.format(index_path(lst)))
+        build(lst)
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,26 @@
+import argparse
 import os
-import sys
 
-def all_words(name: str, lists: list[str], raw: bool=False) -> dict[str, str]:
+from wcache import LexiconCache
+from wcorpus import count_words, prune_words
+
+def all_words(name: str, lists: list[str], raw: bool=False,
+              min_count: int=1, max_words: int=None, jobs: int=None) -> dict[str, str]:
     words = {}
-    for lst in lists:
-        with open(lst, 'r') as f:
-            for line in f:
-                if raw:
+    if raw:
+        for lst in lists:
+            with open(lst, 'r') as f:
+                for line in f:
                     text = line.strip()
                     if ' ' in text:
                         word, spoken = text.split(' ', 1)
                     else:
                         word = spoken = text
                     if word: words[word] = spoken
-                else:
-                    text = line.split(' ', 3)[-1].strip()
-                    for word in text.strip().split():
-                        if word: words[word] = word
+        return words
+    counts = prune_words(count_words(lists, jobs=jobs), min_count=min_count, max_words=max_words)
+    for word in counts:
+        words[word] = word
     return words
 
 def leters(word: str, ctc: bool=False, cap_tokens: bool=False) -> str:
@@ -51,9 +55,19 @@ def leters(word: str, ctc: bool=False, cap_tokens: bool=False) -> str:
         last = c
     return ' '.join(out)
 
-def build_lexicon(name: str, words: dict[str, str], nbest: int=10, ctc: bool=False) -> str:
+def spellings(word: str, ctc: bool=False, cap_tokens: bool=False) -> list[str]:
+    out = []
+    if not cap_tokens and (word.isupper() and len(word) <= 4):
+        out.append(leters(word, ctc=ctc, cap_tokens=True))
+    out.append(leters(word, ctc=ctc, cap_tokens=cap_tokens))
+    return out
+
+def build_lexicon(name: str, words: dict[str, str], nbest: int=10, ctc: bool=False, cache: str=None) -> str:
     lower_words = {word.lower() for word in words if word != word.upper()}
     lexicon_path = name + '.lexicon'
+    lexcache = None
+    if cache is not None:
+        lexcache = LexiconCache(cache, 'wlexicon ctc={}'.format(ctc))
     with open(lexicon_path, 'w') as o:
         for word, spoken in sorted(words.items()):
             if not word.strip("'"):
@@ -61,31 +75,42 @@ def build_lexicon(name: str, words: dict[str, str], nbest: int=10, ctc: bool=Fal
             if spoken == word:
                 lword = word.lower()
                 cap_tokens = (word != lword and lword in lower_words)
-                spoken = leters(word, ctc=ctc, cap_tokens=cap_tokens)
-                if not cap_tokens and (word.isupper() and len(word) <= 4):
-                    spoken2 = leters(word, ctc=ctc, cap_tokens=True)
-                    o.write('{} {} |\n'.format(word, spoken2))
+                if lexcache is None:
+                    spelled = spellings(word, ctc=ctc, cap_tokens=cap_tokens)
+                else:
+                    key = '{} {}'.format(int(cap_tokens), word)
+                    spelled = lexcache.get(key)
+                    if spelled is None:
+                        spelled = spellings(word, ctc=ctc, cap_tokens=cap_tokens)
+                        lexcache.put(key, spelled)
             else:
-                spoken = ' '.join('|'.join(spoken.split())).lower()
-            o.write('{} {} |\n'.format(word, spoken))
+                spelled = [' '.join('|'.join(spoken.split())).lower()]
+            for spoken in spelled:
+                o.write('{} {} |\n'.format(word, spoken))
+    if lexcache is not None:
+        print('[ ] lexicon cache: {} cached, {} new'.format(lexcache.hits, len(lexcache.new)))
+        lexcache.save()
     return lexicon_path
 
-def usage() -> None:
-    print('Usage: wlexicon [--ctc] [--raw] <name> <clips.lst> [clips.lst...]')
-    sys.exit(1)
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wlexicon', usage='wlexicon [--ctc] [--raw] <name> <clips.lst> [clips.lst...]')
+    parser.add_argument('name',  help='lexicon name prefix', type=str)
+    parser.add_argument('lists', help='w2l clips.lst file(s)', type=str, nargs='+')
+    parser.add_argument('--ctc', help='do not collapse repeated letters', action='store_true')
+    parser.add_argument('--raw', help='lists are "word spelling" lines instead of w2l lists', action='store_true')
+    parser.add_argument('--min-count', help='drop words seen fewer than this many times', type=int, default=1)
+    parser.add_argument('--max-words', help='keep only this many of the most frequent words', type=int, default=None)
+    parser.add_argument('--cache', help='persistent lexicon cache directory, only new words are spelled', type=str, default=None)
+    parser.add_argument('--jobs', '-j', help='parallel jobs for word counting (default: cpu count)', type=int, default=None)
+    args = parser.parse_args(argv)
 
-if __name__ == '__main__':
-    ctc = '--ctc' in sys.argv
-    raw = '--raw' in sys.argv
-    if ctc: sys.argv.remove('--ctc')
-    if raw: sys.argv.remove('--raw')
-    if len(sys.argv) < 2:
-        usage()
-
-    name = sys.argv[1]
-    lists = [os.path.abspath(p) for p in sys.argv[2:]]
+    name = args.name
+    lists = [os.path.abspath(p) for p in args.lists]
     print('[+] Finding words')
-    words = all_words(name, lists, raw=raw)
+    words = all_words(name, lists, raw=args.raw, min_count=args.min_count, max_words=args.max_words, jobs=args.jobs)
     print('[+] Generating lexicon')
-    lexicon = build_lexicon(name, words, ctc=ctc)
+    lexicon = build_lexicon(name, words, ctc=args.ctc, cache=args.cache)
     print('[ ] -> {}'.format(lexicon))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import wbucket
+import windex
+
+# Sharded wav2train runs: `wav2train --shard K/N` on each node aligns a stable hash
+# partition of the inputs into <output>/shards/K-of-N/ (align/, clips.lst, manifest.json),
+# with clips written to the shared <output>/clips/. `wmerge <output>` then joins the shards.
+
+def parse_shard(desc):
+    k, n = map(int, desc.split('/', 1))
+    if not 0 <= k < n:
+        raise ValueError('shard must be K/N with 0 <= K < N: {}'.format(desc))
+    return k, n
+
+def shard_of(name, n):
+    """Stable shard number for an input name, the same on every node and python version."""
+    return int(hashlib.sha1(name.encode('utf8')).hexdigest()[:8], 16) % n
+
+def shard_keys(entries):
+    """{input name: shard key} for the .txt DirEntries of an input directory.
+
+    Recordings that share a transcript file (hardlinks of one book) get the first of their names
+    as the key, so a whole book lands on one shard. Others are keyed by their own name.
+    """
+    groups = {}
+    for ent in entries:
+        groups.setdefault(ent.inode(), []).append(ent.name.rsplit('.', 1)[0])
+    return {name: min(names) for names in groups.values() for name in names}
+
+def shard_dir(outdir, k, n):
+    return os.path.join(outdir, 'shards', '{}-of-{}'.format(k, n))
+
+def names_digest(names):
+    return hashlib.sha1('\n'.join(sorted(names)).encode('utf8')).hexdigest()
+
+def write_manifest(work_dir, k, n, inputs, discovered, done=False):
+    manifest = {
+        'shard':      k,
+        'count':      n,
+        'inputs':     sorted(inputs),
+        'discovered': len(discovered),
+        'digest':     names_digest(discovered),
+        'done':       done,
+    }
+    path = os.path.join(work_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as o:
+        json.dump(manifest, o)
+    os.replace(path + '.tmp', path)
+
+def merge(outdir, args=None, force=False):
+    """Join every shard's clips.lst into <outdir>/clips.lst, checking coverage and duplicates."""
+    shards_root = os.path.join(outdir, 'shards')
+    manifests = []
+    for name in sorted(os.listdir(shards_root)):
+        path = os.path.join(shards_root, name, 'manifest.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifests.append((os.path.join(shards_root, name), json.load(f)))
+    if not manifests:
+        raise Exception('no shards found in {}'.format(shards_root))
+
+    errors = []
+    counts = {m['count'] for _, m in manifests}
+    digests = {m['digest'] for _, m in manifests}
+    if len(counts) != 1:
+        errors.append('shards disagree on shard count: {}'.format(sorted(counts)))
+    if len(digests) != 1:
+        errors.append('shards discovered different input sets, was the input directory changed?')
+    n = max(counts)
+    present = {m['shard'] for _, m in manifests if m['count'] == n}
+    missing = sorted(set(range(n)) - present)
+    if missing:
+        errors.append('missing shards: {}'.format(' '.join(map(str, missing))))
+    unfinished = sorted(m['shard'] for _, m in manifests if not m['done'])
+    if unfinished:
+        errors.append('unfinished shards: {}'.format(' '.join(map(str, unfinished))))
+    assigned = sum(len(m['inputs']) for _, m in manifests if m['count'] == n)
+    discovered = manifests[0][1]['discovered']
+    seen_inputs = set()
+    for _, m in manifests:
+        dup = seen_inputs.intersection(m['inputs'])
+        if dup:
+            errors.append('inputs in more than one shard: {}'.format(' '.join(sorted(dup)[:10])))
+        seen_inputs.update(m['inputs'])
+    if not missing and assigned != discovered:
+        errors.append('shards cover {} of {} inputs'.format(assigned, discovered))
+
+    for error in errors:
+        print('[-] {}'.format(error), file=sys.stderr)
+    if errors and not force:
+        raise Exception('refusing to merge incomplete shards (use --force to merge anyway)')
+
+    clips_lst = os.path.join(outdir, 'clips.lst')
+    seen = set()
+    dups = total = 0
+    with open(clips_lst, 'w') as o:
+        for work_dir, _ in manifests:
+            with open(os.path.join(work_dir, 'clips.lst'), 'r') as f:
+                for line in f:
+                    clip_id = line.split(' ', 1)[0]
+                    if not line.strip():
+                        continue
+                    if clip_id in seen:
+                        dups += 1
+                        continue
+                    seen.add(clip_id)
+                    total += 1
+                    o.write(line if line.endswith('\n') else line + '\n')
+    print('[+] merged {} shard(s), {} clips{}'.format(
+        len(manifests), total, ', dropped {} duplicate clip id(s)'.format(dups) if dups else ''))
+    wbucket.reorder_file(clips_lst, args, desc='clips.lst')
+    windex.build(clips_lst)
+    return clips_lst
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wmerge', usage='wmerge [--force] <output_dir>')
+    parser.add_argument('output_dir', help='wav2train output directory containing shards/')
+    parser.add_argument('--force',    help='merge even if shards are missing or unfinished', action='store_true')
+    wbucket.add_arguments(parser)
+    args = parser.parse_args(argv)
+    merge(os.path.abspath(args.output_dir), args, force=args.force)
+
+if __name__ == '__main__':
+    main()
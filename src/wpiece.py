@@ -1,54 +1,75 @@
+from collections import Counter
+from multiprocessing import Pool
 import argparse
+import itertools
 import os
-import sentencepiece as spm
 import sys
 
-def build_corpus(name, lists=(), corpora=()):
-    words = set()
-    if not lists and len(corpora) == 1:
-        # fast path for using an existing text corpus
-        with open(corpora[0], 'r') as f:
+from wcache import LexiconCache, file_hash
+from wcorpus import count_words, list_text, prune_words
+
+def iter_sentences(counts, lists=(), corpora=(), dedup=False):
+    """Yield every transcript and corpus line once, counting words into `counts` as they pass."""
+    seen = set()
+    for path, is_list in [(lst, True) for lst in lists] + [(text, False) for text in corpora]:
+        with open(path, 'r') as f:
             for line in f:
-                for word in line.strip().split():
+                if is_list:
+                    text = list_text(line)
+                    counts.update(text.split())
+                else:
+                    text = line.strip()
                     # TODO: use an alphabet whitelist like wav2train?
-                    if word: words.add(word.lower())
-        return corpora[0], words
-
-    corpus_path = name + '.corpus'
-    with open(corpus_path, 'w') as o:
-        for lst in lists:
-            with open(lst, 'r') as f:
-                for line in f:
-                    text = line.split(' ', 3)[-1].strip()
-                    for word in text.strip().split():
-                        if word: words.add(word)
-                    o.write(text + '\n')
-        for text in corpora:
-            with open(text, 'r') as f:
-                for line in f:
-                    for word in line.strip().split():
-                        # TODO: use an alphabet whitelist like wav2train?
-                        if word: words.add(word.lower())
-                    o.write(line.rstrip() + '\n')
-    return corpus_path, words
-
-def train_spm(name, corpus_path, vocab_size=10000, nthread=1):
-    spm_args = ('--input={} --model_prefix={} --vocab_size={} --num_threads={} '
-                '--hard_vocab_limit=false '
-                '--character_coverage=1.0 '
-                '--normalization_rule_name=nmt_nfkc').format(
-                    corpus_path, name, int(vocab_size), int(nthread))
-    spm.SentencePieceTrainer.Train(spm_args)
-
-def build_lexicon(name, words, nbest=10, spm_path=None):
+                    counts.update(text.lower().split())
+                if not text:
+                    continue
+                if dedup:
+                    # 64-bit hashes keep the seen set small, a rare collision only drops a sentence
+                    h = hash(text)
+                    if h in seen:
+                        continue
+                    seen.add(h)
+                yield text
+
+def train_spm(name, sentences, vocab_size=10000, nthread=1, sample=None):
+    import sentencepiece as spm
+    kwargs = {}
+    if sample:
+        # let the trainer reservoir sample the stream to cap its memory
+        kwargs = {'input_sentence_size': int(sample), 'shuffle_input_sentence': True}
+    spm.SentencePieceTrainer.Train(
+        sentence_iterator=sentences,
+        model_prefix=name,
+        vocab_size=int(vocab_size),
+        num_threads=int(nthread),
+        hard_vocab_limit=False,
+        character_coverage=1.0,
+        normalization_rule_name='nmt_nfkc',
+        **kwargs)
+
+encode_sp = None
+
+def encode_init(model_path):
+    global encode_sp
+    import sentencepiece as spm
+    encode_sp = spm.SentencePieceProcessor()
+    encode_sp.Load(model_path)
+
+def encode_batch(args):
+    words, nbest = args
+    out = []
+    for word in words:
+        wps = encode_sp.NBestEncodeAsPieces(word, nbest)
+        out.append([' '.join([w.replace('\u2581', '_') for w in wp]) for wp in wps])
+    return out
+
+def build_lexicon(name, words, nbest=10, spm_path=None, cache=None, jobs=1, batch_size=1000):
     if spm_path is None:
         spm_path = name
     model_path = spm_path + '.model'
     vocab_path = spm_path + '.vocab'
     if os.path.isfile(spm_path) and not os.path.isfile(model_path):
         model_path = spm_path
-    sp = spm.SentencePieceProcessor()
-    sp.Load(model_path)
 
     if not os.path.exists(vocab_path):
         print('[-] spm vocab file ({}) not found, skipping token generation'.format(vocab_path))
@@ -60,25 +81,65 @@ def build_lexicon(name, words, nbest=10, spm_path=None):
                 if tok not in exclude:
                     o.write(tok.replace('\u2581', '_') + '\n')
 
+    lexcache = None
+    if cache is not None:
+        lexcache = LexiconCache(cache, 'wpiece model={} nbest={}'.format(file_hash(model_path), nbest))
+
+    words = sorted(words)
+    todo = words
+    if lexcache is not None:
+        todo = [word for word in words if word not in lexcache.entries]
+    batches = [(todo[i:i+batch_size], nbest) for i in range(0, len(todo), batch_size)]
+
+    pool = None
+    if jobs > 1 and len(batches) > 1:
+        # each worker loads the model once, batches come back in order
+        pool = Pool(jobs, initializer=encode_init, initargs=(model_path,))
+        encoded = pool.imap(encode_batch, batches)
+    else:
+        encode_init(model_path)
+        encoded = map(encode_batch, batches)
+    encoded = itertools.chain.from_iterable(encoded)
+
     lexicon_path = name + '.lexicon'
-    with open(lexicon_path, 'w') as o:
-        for word in sorted(words):
-            wps = sp.NBestEncodeAsPieces(word, nbest)
-            for wp in wps:
-                wpstr = ' '.join([w.replace('\u2581', '_') for w in wp])
-                o.write('{}\t{}\n'.format(word, wpstr))
+    try:
+        with open(lexicon_path, 'w') as o:
+            for word in words:
+                wpstrs = lexcache.get(word) if lexcache is not None else None
+                if wpstrs is None:
+                    wpstrs = next(encoded)
+                    if lexcache is not None:
+                        lexcache.put(word, wpstrs)
+                for wpstr in wpstrs:
+                    o.write('{}\t{}\n'.format(word, wpstr))
+    except BaseException:
+        # don't wait for workers still encoding batches nobody will read
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if lexcache is not None:
+        print('[ ] lexicon cache: {} cached, {} new'.format(lexcache.hits, len(lexcache.new)))
+        lexcache.save()
     return lexicon_path
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wpiece')
     parser.add_argument('name', help='model name prefix', type=str)
     parser.add_argument('--text', help='path to corpus text file(s)', type=str, nargs='*')
     parser.add_argument('--list',  help='w2l clips.lst file(s)', type=str, nargs='*')
     parser.add_argument('--model',   '-m', help='pre-trained sentencepiece model', type=str, default=None)
     parser.add_argument('--nbest',   '-n', help='number of word piece samples for lexicon', type=int, default=10)
     parser.add_argument('--ntoken',  '-w', help='number of tokens in vocabulary to train', type=int, default=10000)
-    parser.add_argument('--nthread', '-j', help='number of threads to use for training', type=int, default=1)
-    args = parser.parse_args()
+    parser.add_argument('--nthread', '-j', help='number of threads to use for training and lexicon generation', type=int, default=1)
+    parser.add_argument('--cache',         help='persistent lexicon cache directory, only new words are encoded', type=str, default=None)
+    parser.add_argument('--sample',        help='train on a random sample of this many sentences', type=int, default=None)
+    parser.add_argument('--dedup',         help='skip repeated sentences when training', action='store_true')
+    parser.add_argument('--min-count',     help='drop lexicon words seen fewer than this many times', type=int, default=1)
+    parser.add_argument('--max-words',     help='keep only this many of the most frequent lexicon words', type=int, default=None)
+    args = parser.parse_args(argv)
 
     if not (args.text or args.list):
         print('Error: you must provide --text or --list')
@@ -88,10 +149,9 @@ if __name__ == '__main__':
     name = args.name
     lists = [os.path.abspath(p) for p in args.list or ()]
     corpora = [os.path.abspath(p) for p in args.text or ()]
-    print('[+] Processing corpus')
-    corpus, words = build_corpus(args.name, lists=lists, corpora=corpora)
-    print('[ ] -> {}'.format(corpus))
     if args.model:
+        print('[+] Processing corpus')
+        words = count_words(lists, corpora)
         print('[+] Using existing SentencePieceModel:', args.model)
         # strip .model so we get .vocab too
         model = args.model
@@ -99,8 +159,18 @@ if __name__ == '__main__':
             model = model.rsplit('.', 1)[0]
     else:
         print('[+] Training SentencePieceModel')
-        train_spm(args.name, corpus, vocab_size=args.ntoken, nthread=args.nthread)
+        # words are counted while the trainer streams the corpus, so it is only read once
+        words = Counter()
+        sentences = iter_sentences(words, lists=lists, corpora=corpora, dedup=args.dedup)
+        train_spm(args.name, sentences, vocab_size=args.ntoken, nthread=args.nthread, sample=args.sample)
+        for _ in sentences:
+            pass
         model = args.name
+    words = prune_words(words, min_count=args.min_count, max_words=args.max_words)
     print('[+] Generating lexicon')
-    lexicon = build_lexicon(args.name, words, nbest=args.nbest, spm_path=model)
+    lexicon = build_lexicon(args.name, words, nbest=args.nbest, spm_path=model, cache=args.cache,
+                            jobs=args.nthread)
     print('[ ] -> {}'.format(lexicon))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import windex
+
+def clip_path(lst, clip):
+    if os.path.exists(clip):
+        return clip
+    # try to rebase
+    clip = os.path.join(os.path.dirname(lst), 'clips', os.path.basename(clip))
+    if os.path.exists(clip):
+        return clip
+    return None
+
+def play(lst, start=0):
+    if start:
+        # seek straight to clip N through the sidecar index
+        with windex.load(lst, build_missing=True) as idx:
+            play_lines(lst, idx.lines(range(start, len(idx))))
+    else:
+        with open(lst, 'r') as f:
+            play_lines(lst, f)
+
+def play_lines(lst, lines):
+    for line in lines:
+        parts = line.rstrip('\n').split(' ', 3)
+        if len(parts) < 4:
+            continue
+        clip = clip_path(lst, parts[1])
+        if clip is None:
+            continue
+        print('[+] {} | {}'.format(parts[3], clip))
+        ret = subprocess.call(['play', '-q', clip, 'silence', '1', '0.1', '1%', '1', '0.1', '1%', 'speed', '1.25'],
+                              stderr=subprocess.STDOUT)
+        if ret:
+            sys.exit(ret)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wplay', usage='wplay [--start N] <clips.lst> [...clips.lst]')
+    parser.add_argument('lists',   help='w2l clips.lst file(s)', nargs='+')
+    parser.add_argument('--start', help='start playing at clip N (0-based line number)', type=int, default=0)
+    args = parser.parse_args(argv)
+    for lst in args.lists:
+        play(lst, start=args.start)
+
+if __name__ == '__main__':
+    main()
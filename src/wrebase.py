@@ -1,41 +1,100 @@
+from multiprocessing import Pool
+import argparse
+import mmap
 import os
-import sys
+import re
 import traceback
 
-def rebase(data_dir):
-    clips_path = os.path.abspath(os.path.join(data_dir, 'clips')).encode('utf8')
-    if not os.path.exists(clips_path):
+# matches the "<id> <prefix>/clips/" head of a list line, as long as the clip sits directly in clips/
+clip_prefix_re = re.compile(rb'^([^ \n]* )(?:[^ \n]*/)?clips/(?=[^ /\n]* )', re.M)
+chunk_size = 64 * 1024 * 1024
+
+def absolute_line(line, base_dir):
+    """`line` with a relative clip path, as --relative writes them, resolved against base_dir."""
+    parts = line.split(' ', 2)
+    if len(parts) == 3 and not os.path.isabs(parts[1]):
+        parts[1] = os.path.join(base_dir, parts[1])
+        return ' '.join(parts)
+    return line
+
+def rebase_list(args):
+    path, clips_path = args
+    # escape the prefix so it is safe to use in a sub() template
+    repl = b'\\1' + (clips_path + b'/').replace(b'\\', b'\\\\')
+    tmp = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+    with open(tmp, 'wb') as o, open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = 0
+                while pos < size:
+                    end = min(size, pos + chunk_size)
+                    if end < size:
+                        # only substitute whole lines, so split the buffer after a newline
+                        nl = mm.rfind(b'\n', pos, end)
+                        end = nl + 1 if nl >= pos else (mm.find(b'\n', end) + 1 or size)
+                    o.write(clip_prefix_re.sub(repl, mm[pos:end]))
+                    pos = end
+    os.rename(path, path + '.tmp')
+    try:
+        os.rename(tmp, path)
+    except Exception:
+        traceback.print_exc()
+        os.rename(path + '.tmp', path)
+        os.unlink(tmp)
+        return path, False
+    os.unlink(path + '.tmp')
+    return path, True
+
+def rebase_job(job):
+    try:
+        return rebase_list(job)
+    except Exception:
+        traceback.print_exc()
+        return job[0], False
+
+def find_lists(data_dir, relative=False):
+    if relative:
+        clips_path = b'clips'
+    else:
+        clips_path = os.path.abspath(os.path.join(data_dir, 'clips')).encode('utf8')
+    if not os.path.exists(os.path.join(data_dir, 'clips')):
         raise Exception('cannot rebase this directory: no clips/')
-    for name in os.listdir(data_dir):
-        if name.endswith('.lst'):
-            path = os.path.join(data_dir, name)
-            print('[+]', path)
-            tmp = os.path.join(os.path.dirname(path), '.{}.tmp'.format(name))
-            with open(tmp, 'wb') as o, open(path, 'rb') as f:
-                for line in f:
-                    parts = line.split(b' ', 3)
-                    if os.path.basename(os.path.dirname(parts[1])) == b'clips':
-                        parts[1] = os.path.join(clips_path, os.path.basename(parts[1]))
-                    line = b' '.join(parts)
-                    o.write(line)
-            o.close()
-            os.rename(path, path + '.tmp')
-            try:
-                os.rename(tmp, path)
-            except Exception:
-                traceback.print_exc()
-                os.rename(path + '.tmp', path)
-                os.unlink(tmp)
-                continue
-            os.unlink(path + '.tmp')
+    return [(os.path.join(data_dir, name), clips_path)
+            for name in sorted(os.listdir(data_dir))
+            if name.endswith('.lst')]
 
-if __name__ == '__main__':
-    if len(sys.argv) <= 1:
-        print('Usage: wrebase <dir> [dir...]')
-        sys.exit(1)
+def rebase(data_dir, relative=False):
+    for job in find_lists(data_dir, relative=relative):
+        print('[+]', job[0])
+        rebase_list(job)
 
-    for d in sys.argv[1:]:
-        try: rebase(d)
+def rebase_all(dirs, relative=False, jobs=None):
+    queue = []
+    for d in dirs:
+        try:
+            queue += find_lists(d, relative=relative)
         except Exception:
             print('Error rebasing:', d)
             traceback.print_exc()
+    if not queue:
+        return
+    # the biggest lists dominate, so start them first
+    queue.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+    with Pool(jobs) as pool:
+        for path, ok in pool.imap_unordered(rebase_job, queue):
+            if ok:
+                print('[+]', path)
+            else:
+                print('Error rebasing:', path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wrebase', usage='wrebase [--relative] [-j N] <dir> [dir...]')
+    parser.add_argument('dirs',     help='dataset directories containing clips/ and *.lst', nargs='+')
+    parser.add_argument('--relative', help='write clip paths relative to the list directory (clips/<name>)', action='store_true')
+    parser.add_argument('--jobs', '-j', help='lists to rebase in parallel (default: cpu count)', type=int, default=None)
+    args = parser.parse_args(argv)
+    rebase_all(args.dirs, relative=args.relative, jobs=args.jobs)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,24 @@
+import argparse
+import mmap
 import os
 import random
-import sys
 
-def split(lst_path):
-    with open(lst_path, 'rb') as f:
-        lines = f.read().strip().split(b'\n')
+import wbucket
+import windex
+
+def read_lines(lst_path):
+    idx = windex.load(lst_path)
+    if idx is None:
+        # malformed lines are dropped, as the index does
+        with open(lst_path, 'rb') as f:
+            return [line.rstrip(b'\r\n') for line in f if windex.well_formed(line)]
+    # with a fresh index, shuffle line numbers and slice the lines out of one mapping
+    with idx, open(lst_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = idx.offsets
+        return [mm[offsets[i]:offsets[i + 1]].rstrip(b'\r\n') for i in idx.valid()]
+
+def split(lst_path, args=None):
+    lines = read_lines(lst_path)
     random.shuffle(lines)
 
     if len(lines) < 3:
@@ -19,6 +33,8 @@ def split(lst_path):
 
     train_lines, lines      = lines[:train_size], lines[train_size:]
     dev_lines,   test_lines = lines[:dev_size], lines[dev_size:]
+    if args is not None:
+        train_lines = wbucket.reorder(train_lines, args, desc='train')
 
     base = os.path.dirname(lst_path)
     with open(os.path.join(base, 'train.lst'), 'wb') as f:
@@ -31,8 +47,12 @@ def split(lst_path):
         for line in test_lines:
             f.write(line + b'\n')
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wsplit', usage='wsplit [--order sorted|bucket] <clips.lst>')
+    parser.add_argument('lst', help='input lst dataset file', type=str)
+    wbucket.add_arguments(parser)
+    args = parser.parse_args(argv)
+    split(args.lst, args)
+
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Usage: wsplit <clips.lst>')
-        sys.exit(1)
-    split(sys.argv[1])
+    main()
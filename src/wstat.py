@@ -0,0 +1,29 @@
+import sys
+
+import windex
+
+def stat(lst):
+    with windex.load(lst, build_missing=True) as idx:
+        durations = [d for d in idx.durations if d == d]
+        return {
+            'count':  len(idx),
+            'hours':  sum(durations) / 1000.0 / 60.0 / 60.0,
+            'maxtsz': max(idx.text_lens, default=0),
+            'minisz': round(min(durations), 3) if durations else None,
+            'maxisz': round(max(durations), 3) if durations else None,
+        }
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    for lst in argv:
+        print('[-] {}'.format(lst))
+        stats = stat(lst)
+        print('  {} clips'.format(stats['count']))
+        print('  {:.3f} hours'.format(stats['hours']))
+        print('  maxtsz={}'.format(stats['maxtsz']))
+        print('  minisz={}'.format(stats['minisz']))
+        print('  maxisz={}'.format(stats['maxisz']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+from collections import deque
+from multiprocessing.pool import Pool
+import json
+import logging
+import multiprocessing
+import os
+import queue
+
+# Cross-file transcription for alignment. Voice activity detection runs per file in a pool,
+# the voiced fragments of every file are cut into length-sorted batches for a few long-lived
+# STT workers, and each file's transcripts are written back as the DSAlign transcription log
+# (.tlog), which align.py then aligns from without loading a model of its own.
+
+rate = 16000
+default_batch_size = 32
+# fragments queued before they are sorted by length and cut into batches, per batch
+sort_batches = 8
+# batches handed to a worker before it has returned any
+queued_batches = 2
+vad_frame_ms = 30
+vad_padding = 10
+vad_threshold = 0.5
+
+stt_model = None
+
+def load_stt(model_dir):
+    global stt_model
+    if stt_model is None:
+        import deepspeech
+        for graph in ('output_graph.pbmm', 'output_graph.pb'):
+            path = os.path.join(model_dir, graph)
+            if os.path.exists(path):
+                break
+        else:
+            raise FileNotFoundError('no output_graph in {}'.format(model_dir))
+        try:
+            stt_model = deepspeech.Model(path)
+        except TypeError:
+            # deepspeech < 0.7 takes a beam width
+            stt_model = deepspeech.Model(path, 500)
+    return stt_model
+
+class DeepSpeechModel:
+    """The model in `model_dir`, without a scorer. deepspeech has no batched call, so a batch
+    still runs fragment by fragment, but the model is loaded once per worker instead of per file."""
+    def __init__(self, model_dir):
+        self.model = load_stt(model_dir)
+
+    def transcribe(self, batch):
+        return [self.model.stt(x) for x in batch]
+
+class StubModel:
+    """Stands in for a real model when testing the pipeline: one word per started second."""
+    def __init__(self, model_dir=None):
+        pass
+
+    def transcribe(self, batch):
+        return [' '.join(['stub'] * -(-len(x) // rate)) for x in batch]
+
+backends = {
+    'deepspeech': DeepSpeechModel,
+    'stub':       StubModel,
+}
+
+def vad_split(raw, aggressiveness=2, frame_ms=vad_frame_ms, padding=vad_padding, threshold=vad_threshold):
+    """(start, end) sample ranges of voiced audio in 16kHz 16-bit mono `raw`.
+
+    The same ring buffer scheme as DSAlign's own VAD: a fragment opens once more than `threshold`
+    of the last `padding` frames are voiced, and closes once more than that are unvoiced.
+    """
+    import webrtcvad
+    vad = webrtcvad.Vad(int(aggressiveness))
+    frame = rate * frame_ms // 1000
+    count = len(raw) // 2 // frame
+    ring = deque(maxlen=padding)
+    triggered = False
+    start = 0
+    for i in range(count):
+        speech = vad.is_speech(raw[i * frame * 2:(i + 1) * frame * 2], rate)
+        ring.append((i, speech))
+        voiced = sum(1 for _, s in ring if s)
+        if not triggered:
+            if voiced > threshold * padding:
+                triggered = True
+                start = ring[0][0]
+                ring.clear()
+        elif len(ring) - voiced > threshold * padding:
+            triggered = False
+            ring.clear()
+            yield start * frame, (i + 1) * frame
+    if triggered:
+        yield start * frame, count * frame
+
+def vad(args):
+    """Decode a file to raw PCM next to its tlog and split it, in a pool worker."""
+    from pydub import AudioSegment
+    audio_file, pcm_path, aggressiveness = args
+    try:
+        audio = (AudioSegment.from_file(audio_file)
+                 .set_channels(1)
+                 .set_frame_rate(rate)
+                 .set_sample_width(2))
+        raw = audio.raw_data
+        with open(pcm_path, 'wb') as o:
+            o.write(raw)
+        return audio_file, list(vad_split(raw, aggressiveness)), None
+    except Exception as e:
+        try: os.unlink(pcm_path)
+        except Exception: pass
+        return audio_file, None, '{}: {}'.format(type(e).__name__, e)
+
+def read_samples(pcm_path, start, end):
+    import numpy as np
+    return np.fromfile(pcm_path, dtype=np.int16, count=end - start, offset=start * 2)
+
+def stt_worker(n, backend, model_dir, requests, results):
+    model = backends[backend](model_dir)
+    while True:
+        batch = requests.get()
+        if batch is None:
+            break
+        try:
+            texts = model.transcribe([read_samples(path, start, end) for _, _, path, start, end in batch])
+        except Exception:
+            logging.debug('[-] STT batch failed', exc_info=True)
+            texts = [None] * len(batch)
+        results.put((n, [(key, i, text) for (key, i, _, _, _), text in zip(batch, texts)]))
+
+def write_tlog(tlog_path, fragments, texts):
+    # the format DSAlign writes itself, times in ms
+    tlog = [{'start': start * 1000 // rate, 'end': end * 1000 // rate, 'transcript': text}
+            for (start, end), text in zip(fragments, texts) if text]
+    with open(tlog_path + '.tmp', 'w') as o:
+        json.dump(tlog, o)
+    os.replace(tlog_path + '.tmp', tlog_path)
+
+class Service:
+    """Long-lived STT workers fed with batches of fragments gathered from many files.
+
+    Each worker has its own request queue, so the batches a dead worker held are known:
+    they are sent to another worker once, and fail their files if that worker dies too.
+    """
+    def __init__(self, workers, backend='deepspeech', model_dir=None, batch_size=default_batch_size):
+        self.batch_size = batch_size
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for n in range(workers):
+            requests = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=stt_worker, args=(n, backend, model_dir, requests, self.results), daemon=True)
+            proc.start()
+            self.workers.append({'proc': proc, 'requests': requests, 'inflight': deque(), 'dead': False})
+        self.pending = []
+        self.retry = []
+        self.files = {}
+        self.done = []
+
+    def add(self, key, pcm_path, tlog_path, fragments):
+        """Queue a file's fragments. Returns the (key, error) pairs of files finished meanwhile."""
+        self.files[key] = {'pcm': pcm_path, 'tlog': tlog_path, 'fragments': fragments, 'texts': [None] * len(fragments),
+                           'seen': [False] * len(fragments), 'left': len(fragments), 'failed': False}
+        if not fragments:
+            self.finish(key)
+        else:
+            self.pending += [(key, i, pcm_path, start, end) for i, (start, end) in enumerate(fragments)]
+            if len(self.pending) >= self.batch_size * sort_batches:
+                self.dispatch(full_only=True)
+        self.poll()
+        return self.take()
+
+    def take(self):
+        done, self.done = self.done, []
+        return done
+
+    def dispatch(self, full_only=False):
+        self.pending.sort(key=lambda frag: frag[4] - frag[3])
+        while self.pending and (len(self.pending) >= self.batch_size or not full_only):
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            self.send(batch)
+
+    def send(self, batch, attempt=0):
+        while True:
+            self.reap()
+            worker = min((w for w in self.workers if not w['dead']), key=lambda w: len(w['inflight']))
+            if len(worker['inflight']) < queued_batches:
+                break
+            self.receive(timeout=1)
+        worker['inflight'].append((attempt, batch))
+        worker['requests'].put(batch)
+
+    def receive(self, timeout):
+        """Handle one result, returns False if none arrived in time."""
+        try:
+            n, result = self.results.get(timeout=timeout)
+        except queue.Empty:
+            self.reap()
+            return False
+        worker = self.workers[n]
+        if worker['inflight']:
+            worker['inflight'].popleft()
+        for key, i, text in result:
+            self.record(key, i, text)
+        return True
+
+    def reap(self):
+        """Take back the batches of workers that died, raise once none are left."""
+        for worker in self.workers:
+            if worker['dead'] or worker['proc'].is_alive():
+                continue
+            worker['dead'] = True
+            worker['requests'].cancel_join_thread()
+            logging.debug('[-] STT worker exited with status {}'.format(worker['proc'].exitcode))
+            while worker['inflight']:
+                attempt, batch = worker['inflight'].popleft()
+                if attempt:
+                    for key, i, _, _, _ in batch:
+                        self.record(key, i, None)
+                else:
+                    self.retry.append(batch)
+        if all(worker['dead'] for worker in self.workers):
+            raise RuntimeError('all STT workers exited')
+
+    def record(self, key, i, text):
+        info = self.files.get(key)
+        # a batch resent after its worker died can still come back from that worker
+        if info is None or info['seen'][i]:
+            return
+        info['seen'][i] = True
+        info['texts'][i] = text
+        info['failed'] |= text is None
+        info['left'] -= 1
+        if not info['left']:
+            self.finish(key)
+
+    def poll(self, block=False):
+        while self.retry:
+            self.send(self.retry.pop(), attempt=1)
+        if block:
+            self.receive(timeout=1)
+        while self.receive(timeout=0.01):
+            pass
+
+    def finish(self, key):
+        info = self.files.pop(key)
+        error = None
+        if info['failed']:
+            error = 'transcription failed'
+        else:
+            write_tlog(info['tlog'], info['fragments'], info['texts'])
+        try: os.unlink(info['pcm'])
+        except Exception: pass
+        self.done.append((key, error))
+
+    def drain(self):
+        """Send the remaining fragments and yield (key, error) until every file is finished."""
+        self.dispatch()
+        while self.files:
+            self.poll(block=True)
+            yield from self.take()
+
+    def close(self):
+        for worker in self.workers:
+            if worker['proc'].is_alive():
+                worker['requests'].put(None)
+            else:
+                worker['requests'].cancel_join_thread()
+        for worker in self.workers:
+            worker['proc'].join(timeout=10)
+            if worker['proc'].is_alive():
+                worker['proc'].terminate()
+        for info in self.files.values():
+            try: os.unlink(info['pcm'])
+            except Exception: pass
+
+def transcribe(jobs, workers, vad_jobs, backend='deepspeech', model_dir=None, batch_size=default_batch_size, aggressiveness=2):
+    """Write a tlog for each (audio_file, tlog_path) job, yields (audio_file, error) as files finish."""
+    service = Service(workers, backend=backend, model_dir=model_dir, batch_size=batch_size)
+    pool = Pool(vad_jobs)
+    try:
+        tlogs = {audio_file: tlog_path for audio_file, tlog_path in jobs}
+        vad_args = [(audio_file, tlog_path.rsplit('.', 1)[0] + '.pcm', aggressiveness) for audio_file, tlog_path in jobs]
+        for audio_file, fragments, error in pool.imap_unordered(vad, vad_args):
+            if error is not None:
+                yield audio_file, error
+                continue
+            pcm_path = tlogs[audio_file].rsplit('.', 1)[0] + '.pcm'
+            yield from service.add(audio_file, pcm_path, tlogs[audio_file], fragments)
+        yield from service.drain()
+    finally:
+        pool.terminate()
+        service.close()
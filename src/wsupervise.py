@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import signal
+import subprocess
+import time
+
+# Keeps a few pathological inputs from stalling a whole run: duration-scaled timeouts,
+# kill and retry with backoff, a persistent quarantine list and an end-of-run failure report.
+
+def add_arguments(parser):
+    parser.add_argument('--timeout-base',   help='per-file timeout: base seconds', type=float, default=300.0)
+    parser.add_argument('--timeout-factor', help='per-file timeout: extra seconds per second of audio', type=float, default=4.0)
+    parser.add_argument('--retries',        help='retries for a failed or timed out file', type=int, default=2)
+    parser.add_argument('--backoff',        help='seconds before the first retry, doubling after', type=float, default=5.0)
+    parser.add_argument('--retry-quarantined', help='retry inputs quarantined by earlier runs', action='store_true')
+
+def settings(args):
+    return {
+        'timeout_base':   args.timeout_base,
+        'timeout_factor': args.timeout_factor,
+        'retries':        args.retries,
+        'backoff':        args.backoff,
+    }
+
+def audio_duration(path):
+    """Duration in seconds from ffprobe, or a pessimistic guess from the file size (16kbps)."""
+    argv = ['ffprobe', '-i', path, '-show_entries', 'format=duration', '-v', 'quiet', '-of', 'csv=p=0']
+    try:
+        out = subprocess.check_output(argv, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        return float(out.strip())
+    except Exception:
+        return os.path.getsize(path) / 2000.0
+
+def timeout_for(sup, duration):
+    return sup['timeout_base'] + sup['timeout_factor'] * duration
+
+def wait_retry(sup, attempt):
+    if attempt:
+        time.sleep(sup['backoff'] * 2 ** (attempt - 1))
+
+def communicate(p, timeout):
+    """communicate() with a timeout that kills the whole process group on expiry.
+
+    Start `p` with start_new_session=True so workers it spawned die with it.
+    Returns (stdout, stderr), raises subprocess.TimeoutExpired after the kill.
+    """
+    try:
+        return p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            p.kill()
+        p.communicate()
+        raise
+
+@contextmanager
+def deadline(seconds):
+    """Raise TimeoutError in this (main) thread if the block runs longer than `seconds`."""
+    def expire(signum, frame):
+        raise TimeoutError('timed out after {:.0f}s'.format(seconds))
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def failure(stage, path, error, attempts, elapsed=0.0, duration=0.0):
+    return {
+        'stage':    stage,
+        'input':    path,
+        'error':    error,
+        'attempts': attempts,
+        'elapsed':  round(elapsed, 1),
+        'duration': round(duration, 1),
+    }
+
+class Quarantine:
+    """Input names that exhausted their retries, kept in <dir>/quarantine.lst across runs."""
+    def __init__(self, work_dir):
+        self.path = os.path.join(work_dir, 'quarantine.lst')
+        self.names = set()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.names = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, name):
+        if name not in self.names:
+            self.names.add(name)
+            with open(self.path, 'a') as o:
+                o.write(name + '\n')
+
+    def release(self, names):
+        if not self.names.intersection(names):
+            return
+        self.names -= set(names)
+        with open(self.path, 'w') as o:
+            o.write(''.join(name + '\n' for name in sorted(self.names)))
+
+class Report:
+    """Collects failures and per-file timings, writes <dir>/failures.json and logs a summary."""
+    def __init__(self, work_dir):
+        self.path = os.path.join(work_dir, 'failures.json')
+        self.failures = []
+        self.timings = []
+
+    def time(self, stage, path, elapsed, duration):
+        self.timings.append((stage, path, elapsed, duration))
+
+    def fail(self, info):
+        self.failures.append(info)
+        logging.debug('[-] {} failed for {}: {}'.format(info['stage'], info['input'], info['error']))
+
+    def dump(self, stragglers=5):
+        with open(self.path, 'w') as o:
+            json.dump(self.failures, o, indent=2)
+        if self.failures:
+            logging.info('[-] {} file(s) failed, see {}'.format(len(self.failures), self.path))
+            for info in self.failures:
+                logging.info('    {:8} {} ({}, {} attempt(s))'.format(info['stage'], info['input'], info['error'], info['attempts']))
+        # slowest files relative to their audio length
+        slow = sorted((t for t in self.timings if t[3] > 0), key=lambda t: t[2] / t[3], reverse=True)[:stragglers]
+        if slow:
+            logging.info('[+] Slowest files (seconds per audio second):')
+            for stage, path, elapsed, duration in slow:
+                logging.info('    {:8} {:6.2f} {}'.format(stage, elapsed / duration, path))
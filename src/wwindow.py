@@ -0,0 +1,241 @@
+from collections import Counter, defaultdict
+import json
+import logging
+import os
+import re
+
+import wstt
+
+# Narrows a shared transcript (e.g. a whole book hardlinked for every chapter recording)
+# down to the region a single recording most likely covers, before DSAlign sees it.
+
+rough_seconds = 60
+ngram_size = 3
+bucket_words = 50
+min_votes = 3
+min_confidence = 0.15
+# slack around the window, as a fraction of the expected chapter length
+margin_frac = 0.25
+min_margin = 2000
+# how far a sibling anchor may sit from where the chapter sizes put it, as a fraction of the text
+anchor_slack = 0.1
+
+word_re = re.compile(r"[a-z']+")
+natural_re = re.compile(r'(\d+)')
+
+def natural_key(path):
+    name = os.path.basename(path)
+    return [int(part) if part.isdigit() else part for part in natural_re.split(name)]
+
+def audio_name(path):
+    return os.path.basename(path).rsplit('.', 1)[0]
+
+def load_order(indir):
+    """{name: chapter number} from the chapters.tsv misc/librilight.py writes, empty without one."""
+    order = {}
+    try:
+        with open(os.path.join(indir, 'chapters.tsv'), 'r') as f:
+            for line in f:
+                name, _, index = line.rstrip('\n').partition('\t')
+                if index.isdigit():
+                    order[name] = int(index)
+    except OSError:
+        pass
+    return order
+
+def plan_chapters(pairs):
+    """Group (audio_path, txt_path) pairs that share a transcript file, and order each group.
+
+    The order comes from a chapters.tsv next to the recordings when it lists the whole group,
+    and from the file names otherwise.
+
+    Returns {audio_path: chapter} where chapter describes the recording's place among its siblings:
+    its expected [start, end) fraction of the transcript (by audio file size) and its neighbours' names.
+    Recordings with their own transcript get no chapter and are never windowed.
+    wav2train aligns each group in this order, so every chapter can anchor on its predecessor.
+    """
+    groups = defaultdict(list)
+    for audio_path, txt_path in pairs:
+        st = os.stat(txt_path)
+        groups[(st.st_dev, st.st_ino)].append(audio_path)
+
+    orders = {}
+    chapters = {}
+    for group, members in enumerate(groups.values()):
+        if len(members) < 2:
+            continue
+        members.sort(key=natural_key)
+        indir = os.path.dirname(members[0])
+        if indir not in orders:
+            orders[indir] = load_order(indir)
+        order = orders[indir]
+        if all(audio_name(path) in order for path in members):
+            members.sort(key=lambda path: order[audio_name(path)])
+        sizes = [os.path.getsize(path) for path in members]
+        total = float(sum(sizes)) or 1.0
+        pos = 0
+        for i, path in enumerate(members):
+            chapters[path] = {
+                'group': group,
+                'index': i,
+                'count': len(members),
+                'frac':  (pos / total, (pos + sizes[i]) / total),
+                'prev':  audio_name(members[i - 1]) if i > 0 else None,
+                'next':  audio_name(members[i + 1]) if i < len(members) - 1 else None,
+            }
+            pos += sizes[i]
+    return chapters
+
+def window_path(align_dir, name):
+    return os.path.join(align_dir, name + '.window.json')
+
+def sibling_span(align_dir, name):
+    """Returns the (start, end) transcript offsets an already-aligned sibling matched, or None."""
+    aligned = os.path.join(align_dir, name + '-aligned.json')
+    try:
+        with open(aligned, 'r') as f:
+            segments = json.load(f)
+        offset = 0
+        if os.path.exists(window_path(align_dir, name)):
+            with open(window_path(align_dir, name), 'r') as f:
+                offset = json.load(f)['start']
+    except Exception:
+        return None
+    if not segments:
+        return None
+    start = min(seg['text-start'] for seg in segments)
+    end   = max(seg['text-end']   for seg in segments)
+    return offset + start, offset + end
+
+def rough_transcripts(audio_file, model_dir, seconds=rough_seconds):
+    """Fast, LM-free transcription of the first and last `seconds` of a recording."""
+    from pydub import AudioSegment
+    import numpy as np
+    model = wstt.load_stt(model_dir)
+    audio = (AudioSegment.from_file(audio_file)
+             .set_channels(1)
+             .set_frame_rate(16000)
+             .set_sample_width(2))
+    span = seconds * 1000
+    head = audio[:span]
+    tail = audio[max(0, len(audio) - span):]
+    return [model.stt(np.frombuffer(part.raw_data, np.int16)) for part in (head, tail)]
+
+class BookIndex:
+    def __init__(self, text):
+        self.words = [(m.group(), m.start(), m.end()) for m in word_re.finditer(text.lower())]
+        self.grams = defaultdict(list)
+        tokens = [w for w, _, _ in self.words]
+        for i in range(len(tokens) - ngram_size + 1):
+            self.grams[hash(tuple(tokens[i:i+ngram_size]))].append(i)
+
+    def locate(self, hyp):
+        """Finds where a rough transcript lands in the text.
+
+        Returns (start_char, end_char, confidence) or None. Each matching n-gram votes for the
+        book word where the hypothesis would start, and confidence is the best bucket's share.
+        """
+        tokens = word_re.findall(hyp.lower())
+        grams = [hash(tuple(tokens[i:i+ngram_size])) for i in range(len(tokens) - ngram_size + 1)]
+        if not grams:
+            return None
+        votes = Counter()
+        starts = defaultdict(list)
+        for j, gram in enumerate(grams):
+            for pos in self.grams.get(gram, ()):
+                bucket = (pos - j) // bucket_words
+                votes[bucket] += 1
+                starts[bucket].append(pos - j)
+        if not votes:
+            return None
+        bucket, count = votes.most_common(1)[0]
+        confidence = count / len(grams)
+        if count < min_votes or confidence < min_confidence:
+            return None
+        first = max(0, sorted(starts[bucket])[len(starts[bucket]) // 2])
+        last = min(len(self.words) - 1, first + len(tokens) - 1)
+        return self.words[first][1], self.words[last][2], confidence
+
+def snap(text, start, end):
+    # widen to whitespace so the window never cuts a word in half
+    start = max(0, min(start, len(text)))
+    end = max(start, min(end, len(text)))
+    while start > 0 and not text[start - 1].isspace():
+        start -= 1
+    while end < len(text) and not text[end].isspace():
+        end += 1
+    return start, end
+
+def window(text, audio_file, align_dir, chapter, model_dir=None):
+    """Picks the [start, end) region of `text` to align `audio_file` against.
+
+    Anchors come from already-aligned siblings first, then from n-gram matching a rough
+    transcription of the recording's first and last minute. A sibling anchor must sit near
+    where the chapter sizes put it, and near the rough match when there is one, or the
+    chapter order is suspect and the full text is returned. The chapter's share of the
+    book (by audio size) bounds the side without an anchor. With no anchor at all the
+    confidence is too low to narrow anything and the full text is returned.
+    """
+    full = (0, len(text), 'full')
+    if not chapter or not text:
+        return full
+    expected = (chapter['frac'][1] - chapter['frac'][0]) * len(text)
+    margin = max(min_margin, int(expected * margin_frac))
+    slack = max(margin, int(len(text) * anchor_slack))
+
+    rough = []
+    def locate(part):
+        # rough matches for the head (0) and tail (1), transcribed once and only if needed
+        if not model_dir:
+            return None
+        if not rough:
+            try:
+                book = BookIndex(text)
+                rough.extend(book.locate(hyp) for hyp in rough_transcripts(audio_file, model_dir))
+            except Exception:
+                logging.debug('[-] Rough transcription failed: {}'.format(audio_file), exc_info=True)
+                rough.extend((None, None))
+        return rough[part]
+
+    start = end = None
+    reasons = []
+    if chapter['prev']:
+        span = sibling_span(align_dir, chapter['prev'])
+        if span:
+            match = locate(0)
+            if (abs(span[1] - chapter['frac'][0] * len(text)) > slack or
+                    match and abs(span[1] - match[0]) > margin):
+                return 0, len(text), 'full (prev disagrees)'
+            start = span[1]
+            reasons.append('prev')
+    if chapter['next']:
+        span = sibling_span(align_dir, chapter['next'])
+        if span:
+            match = locate(1)
+            if (abs(span[0] - chapter['frac'][1] * len(text)) > slack or
+                    match and abs(span[0] - match[1]) > margin):
+                return 0, len(text), 'full (next disagrees)'
+            end = span[0]
+            reasons.append('next')
+
+    if start is None:
+        match = locate(0)
+        if match and (end is None or match[0] < end):
+            start = match[0]
+            reasons.append('head {:.2f}'.format(match[2]))
+    if end is None:
+        match = locate(1)
+        if match and (start is None or match[1] > start):
+            end = match[1]
+            reasons.append('tail {:.2f}'.format(match[2]))
+
+    if start is None and end is None:
+        return full
+    if start is None:
+        start = end - int(expected * 2)
+    elif end is None:
+        end = start + int(expected * 2)
+    if end <= start:
+        return full
+    start, end = snap(text, start - margin, end + margin)
+    return start, end, ' '.join(reasons)